@@ -1,18 +1,18 @@
 # Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
 
 import os
-import re
 import sys
 import argparse
 import logging
 import time
-import subprocess
 import functools
 
 import regfile
 import mainmem
 import service
 import toolbox
+import toolbox.elf
+import toolbox.memtrace
 import riscv.decode
 import riscv.execute
 import riscv.constants
@@ -38,9 +38,12 @@ class BasicBlockCore:
         self.snapshots = []
         self.cmdline = None
         self.basicblockcache = {}
+        self.loaded = bytearray(8) # NOTE: filled in place by mainmem.peek_into() on every load
+        self.trace = None # NOTE: a toolbox.memtrace.Trace, if config trace_filename is set
         self.config = {
             'toolchain': '',
             'binary': '',
+            'trace_filename': '',
         }
         self.opcode = {
             'LUI': riscv.execute.lui,
@@ -138,13 +141,13 @@ class BasicBlockCore:
         _addr = int.from_bytes(pc, 'little')
         _size = 4
         while True:
-            _data = self.mainmem.peek(_addr, _size, **{'coreid': self.get('coreid')})
-            assert len(_data) == _size, 'Fetched wrong number of bytes!'
-            _decoded = riscv.decode.do_decode(_data[:], 1)
+            _data = bytearray(_size)
+            assert _size == self.mainmem.peek_into(_addr, _data, **{'coreid': self.get('coreid')}), 'Fetched wrong number of bytes!'
+            _decoded = riscv.decode.do_decode(_data, 1)
             _insn = ({
                 **next(iter(_decoded)),
                 **{'%pc': pc, '_pc': _addr},
-                **({'function': next(filter(lambda x: int.from_bytes(pc, 'little') >= x[0], sorted(self.get('objmap').items(), reverse=True)))[-1].get('name', '')} if self.get('objmap') else {}),
+                **({'function': toolbox.elf.function(self.get('objmap'), int.from_bytes(pc, 'little'))} if self.get('objmap') else {}),
             } if len(_decoded) else None)
             if not _insn:
                 logging.info('_pc       : {}'.format(pc))
@@ -169,6 +172,7 @@ class BasicBlockCore:
             self.regfile = compose(*self.basicblockcache.get(_addr))(self.regfile)
             self.update({'instructions_committed': len(self.basicblockcache.get(_addr)) + self.get('instructions_committed')})
             if -1 == int.from_bytes(self.getregister(self.regfile, '%pc'), 'little', signed=True): break
+        if self.trace: self.trace.flush()
         logging.info('registers : {}'.format(self.regfile.registers))
         logging.info('state.instructions_committed    : {}'.format(self.get('instructions_committed')))
         logging.info('_initial_instructions_committed : {}'.format(_initial_instructions_committed))
@@ -182,6 +186,13 @@ class BasicBlockCore:
             }})
             self.update({'shutdown': True})
     def do_instruction(self, nibble, regs):
+        if self.trace:
+            self.trace.append(nibble.get('insn').get('_pc'), nibble.get('insn').get('size'), toolbox.memtrace.FETCH)
+            if nibble.get('insn').get('cmd') in riscv.constants.LOADS + riscv.constants.STORES: self.trace.append(
+                nibble.get('insn').get('imm', 0) + int.from_bytes(self.getregister(regs, nibble.get('insn').get('rs1')), 'little'),
+                nibble.get('insn').get('nbytes'),
+                (toolbox.memtrace.LOAD if nibble.get('insn').get('cmd') in riscv.constants.LOADS else toolbox.memtrace.STORE),
+            )
         _args = ((nibble.get('insn'), regs) if nibble.get('insn').get('cmd') in riscv.constants.LOADS + riscv.constants.STORES + ['ECALL', 'CSRRS', 'CSSRSI'] else tuple(filter(
             lambda x: None != x, [
                 (self.getregister(regs, '%pc') if nibble.get('insn').get('cmd') in riscv.constants.BRANCHES + riscv.constants.JUMPS + ['AUIPC'] else None),
@@ -221,7 +232,8 @@ class BasicBlockCore:
     def mk_load(self, cmd):
         def fetcher(cmd, n, r, *a, **k):
             _addr = n.get('imm') + int.from_bytes(self.getregister(r, n.get('rs1')), 'little')
-            _fetched = self.mainmem.peek(_addr, n.get('nbytes'), **{'coreid': self.get('coreid')})
+            _n = self.mainmem.peek_into(_addr, memoryview(self.loaded)[:n.get('nbytes')], **{'coreid': self.get('coreid')})
+            _fetched = list(self.loaded[:_n])
             return _fetched + [(0xff if cmd in ['LW', 'LH', 'LB'] and ((_fetched[{'LW': 3, 'LH': 1, 'LB': 0}.get(cmd)] >> 7) & 0b1) else 0)] * {'LD': 0, 'LW': 4, 'LH': 6, 'LB': 7, 'LWU': 4, 'LHU': 6, 'LBU': 7}.get(cmd)
         return functools.partial(fetcher, cmd)
     def mk_store(self, cmd):
@@ -253,9 +265,10 @@ class BasicBlockCore:
             if 'peek' in _side_effect.keys():
                 _addr = _side_effect.get('peek').get('addr')
                 _size = _side_effect.get('peek').get('size')
-                _data = self.mainmem.peek(_addr, _size, **{'coreid': self.get('coreid')})
+                _data = bytearray(_size)
+                _n = self.mainmem.peek_into(_addr, _data, **{'coreid': self.get('coreid')})
                 if 'arg' not in _syscall_kwargs.keys(): _syscall_kwargs.update({'arg': []})
-                _syscall_kwargs.get('arg').append(bytes(_data))
+                _syscall_kwargs.get('arg').append(bytes(_data[:_n]))
         if 'output' in _side_effect.keys():
             _register = _side_effect.get('output').get('register')
             if _register:
@@ -319,22 +332,9 @@ if '__main__' == __name__:
                 state.update({'basicblockcache': {}})
                 _service.tx({'info': 'state.config : {}'.format(state.get('config'))})
                 if state.get('config').get('toolchain'):
-                    _toolchain = state.get('config').get('toolchain')
                     _binary = state.get('binary')
-                    _files = next(iter(list(os.walk(_toolchain))))[-1]
-                    _objdump = next(filter(lambda x: 'objdump' in x, _files))
-                    _x = subprocess.run('{} -t {}'.format(os.path.join(_toolchain, _objdump), _binary).split(), capture_output=True)
-                    if not len(_x.stderr):
-                        _objdump = _x.stdout.decode('ascii').split('\n')
-                        _objdump = sorted(filter(lambda x: len(x), _objdump))
-                        _objdump = filter(lambda x: re.search('^0', x), _objdump)
-                        _objdump = map(lambda x: x.split(), _objdump)
-                        state.update({'objmap': {
-                            int(x[0], 16): {
-                                'flags': x[1:-1],
-                                'name': x[-1]
-                            } for x in _objdump
-                        }})
+                    state.update({'objmap': toolbox.elf.image(_binary)})
+                if state.get('config').get('trace_filename') and not state.get('trace'): state.update({'trace': toolbox.memtrace.Trace(state.get('config').get('trace_filename'))})
                 logging.info('_mainmem.config : {}'.format(_mainmem.get('config')))
                 if not _mainmem.get('booted'): _mainmem.boot()
             elif {'text': 'pause'} == {k: v}:
@@ -365,20 +365,23 @@ if '__main__' == __name__:
                 _args = v.get('args')
                 if not _mainmem.get('booted'): _mainmem.boot()
                 _mainmem.loadbin(_coreid, _start_symbol, _sp, _pc, _binary, *_args)
+                if 'cmdline' in v.keys(): state.update({'cmdline': v.get('cmdline')}) # NOTE: what remains of the command line, i.e., not yet running on any core
             elif 'restore' == k:
                 assert not state.get('running'), 'Attempted restore while running!'
                 logging.info('restore : {}'.format(v))
                 _snapshot_filename = v.get('snapshot_filename')
                 if not _mainmem.get('booted'): _mainmem.boot()
                 _restore = _mainmem.restore(_snapshot_filename)
-                _regfile.registers = _restore.get('registers')
+                _core = _restore.get('cores').get(state.get('coreid'), {}) # NOTE: empty if this core was idle when the snapshot was taken
+                if _core: _regfile.registers = _core.get('registers')
                 _regfile.update({'cycle': _restore.get('cycle')})
                 _mainmem.update({'cycle': _restore.get('cycle')})
                 state.update({'cycle': _restore.get('cycle')})
-                state.update({'instructions_committed': _restore.get('instructions_committed')})
+                state.update({'instructions_committed': _core.get('instructions_committed', 0)})
+                state.update({'cmdline': _restore.get('cmdline', [])})
                 logging.info('state.cycle : {}'.format(state.get('cycle')))
                 logging.info('state.instructions_committed : {}'.format(state.get('instructions_committed')))
-                _service.tx({'ack': {'cycle': state.get('cycle')}})
+                _service.tx({'ack': {'cycle': state.get('cycle'), 'restore': {'cores': list(_restore.get('cores').keys()), 'cmdline': _restore.get('cmdline')}}})
             elif 'snapshots' == k:
                 state.update({'snapshots': v.get('checkpoints')})
                 state.update({'cmdline': v.get('cmdline')})
@@ -394,7 +397,12 @@ if '__main__' == __name__:
                         'cycle': state.get('cycle'),
                         'instructions_committed': state.get('instructions_committed'),
                         'cmdline': state.get('cmdline'),
-                        'registers': _regfile.registers,
+                        'cores': {
+                            state.get('coreid'): {
+                                'instructions_committed': state.get('instructions_committed'),
+                                'registers': _regfile.registers,
+                            },
+                        },
                     })
             elif 'register' == k:
                 logging.info('register : {}'.format(v))
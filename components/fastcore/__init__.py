@@ -1,17 +1,17 @@
 # Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
 
 import os
-import re
 import sys
 import argparse
 import logging
 import time
-import subprocess
 
 import regfile
 import mainmem
 import service
 import toolbox
+import toolbox.elf
+import toolbox.memtrace
 import riscv.decode
 import riscv.execute
 import riscv.constants
@@ -34,9 +34,13 @@ class FastCore:
         self.objmap = None
         self.snapshots = []
         self.cmdline = None
+        self.fetched = bytearray(4) # NOTE: filled in place by mainmem.peek_into() on every instruction fetch
+        self.loaded = bytearray(8)  # NOTE: ditto, on every load
+        self.trace = None # NOTE: a toolbox.memtrace.Trace, if config trace_filename is set
         self.config = {
             'toolchain': '',
             'binary': '',
+            'trace_filename': '',
         }
         self.opcode = {
             'LUI': self.do_lui,
@@ -132,14 +136,14 @@ class FastCore:
             _pc = self.getregister(self.regfile, '%pc')
             _addr = int.from_bytes(_pc, 'little')
             _size = 4
-            _data = self.mainmem.peek(_addr, _size, **{'coreid': self.get('coreid')})
-            assert len(_data) == _size, 'Fetched wrong number of bytes!'
-            _decoded = riscv.decode.do_decode(_data[:], 1)
+            _data = self.fetched
+            assert _size == self.mainmem.peek_into(_addr, _data, **{'coreid': self.get('coreid')}), 'Fetched wrong number of bytes!'
+            _decoded = riscv.decode.do_decode(_data, 1)
             _insn = ({
                 **next(iter(_decoded)),
                 **{'iid': state.get('instructions_committed')},
                 **{'%pc': _pc, '_pc': _addr},
-                **({'function': next(filter(lambda x: int.from_bytes(_pc, 'little') >= x[0], sorted(self.get('objmap').items(), reverse=True)))[-1].get('name', '')} if self.get('objmap') else {}),
+                **({'function': toolbox.elf.function(self.get('objmap'), int.from_bytes(_pc, 'little'))} if self.get('objmap') else {}),
             } if len(_decoded) else None)
             if not _insn:
                 logging.info('_pc       : {}'.format(_pc))
@@ -147,10 +151,12 @@ class FastCore:
                 logging.info('_size     : {}'.format(_size))
                 logging.info('_decoded  : {}'.format(_decoded))
                 break
+            if self.trace: self.trace.append(_addr, _insn.get('size'), toolbox.memtrace.FETCH)
             _result = self.opcode.get(_insn.get('cmd'), self.do_unimplemented)(_insn, self.service, self.state())
 #            logging.info('_result   : {}'.format(_result))
             self.update({'instructions_committed': 1 + self.get('instructions_committed')})
             if 'shutdown' in _result.keys(): break
+        if self.trace: self.trace.flush()
         logging.info('registers : {}'.format(self.regfile.registers))
         logging.info('state.instructions_committed    : {}'.format(self.get('instructions_committed')))
         logging.info('_initial_instructions_committed : {}'.format(_initial_instructions_committed))
@@ -289,8 +295,9 @@ class FastCore:
             'rs1': self.getregister(self.regfile, insn.get('rs1')),
         }
         _addr = insn.get('imm') + int.from_bytes(_operands.get('rs1'), 'little')
-        _fetched  = self.mainmem.peek(_addr, insn.get('nbytes'), **{'coreid': self.get('coreid')})
-        _fetched += [-1] * (8 - len(_fetched))
+        if self.trace: self.trace.append(_addr, insn.get('nbytes'), toolbox.memtrace.LOAD)
+        _n = self.mainmem.peek_into(_addr, memoryview(self.loaded)[:insn.get('nbytes')], **{'coreid': self.get('coreid')})
+        _fetched = list(self.loaded[:_n]) + [-1] * (8 - _n)
         _data = { # HACK: This is 100% little-endian-specific
             'LD': _fetched,
             'LW': _fetched[:4] + [(0xff if ((_fetched[3] >> 7) & 0b1) else 0)] * 4,
@@ -320,6 +327,7 @@ class FastCore:
             'SB': _data[:1],
         }.get(insn.get('cmd'))
         _addr = insn.get('imm') + int.from_bytes(_operands.get('rs1'), 'little')
+        if self.trace: self.trace.append(_addr, insn.get('nbytes'), toolbox.memtrace.STORE)
         self.mainmem.poke(_addr, insn.get('nbytes'), _data, **{'coreid': self.get('coreid')})
         self.setregister(self.regfile, '%pc', riscv.constants.integer_to_list_of_bytes(int.from_bytes(insn.get('%pc'), 'little') + insn.get('size'), 64, 'little'))
         return {
@@ -376,9 +384,10 @@ class FastCore:
             if 'peek' in _side_effect.keys():
                 _addr = _side_effect.get('peek').get('addr')
                 _size = _side_effect.get('peek').get('size')
-                _data = self.mainmem.peek(_addr, _size, **{'coreid': self.get('coreid')})
+                _data = bytearray(_size)
+                _n = self.mainmem.peek_into(_addr, _data, **{'coreid': self.get('coreid')})
                 if 'arg' not in _syscall_kwargs.keys(): _syscall_kwargs.update({'arg': []})
-                _syscall_kwargs.get('arg').append(bytes(_data))
+                _syscall_kwargs.get('arg').append(bytes(_data[:_n]))
         if 'output' in _side_effect.keys():
             _register = _side_effect.get('output').get('register')
             if _register:
@@ -454,22 +463,9 @@ if '__main__' == __name__:
                 state.update({'shutdown': None})
                 _service.tx({'info': 'state.config : {}'.format(state.get('config'))})
                 if state.get('config').get('toolchain'):
-                    _toolchain = state.get('config').get('toolchain')
                     _binary = state.get('binary')
-                    _files = next(iter(list(os.walk(_toolchain))))[-1]
-                    _objdump = next(filter(lambda x: 'objdump' in x, _files))
-                    _x = subprocess.run('{} -t {}'.format(os.path.join(_toolchain, _objdump), _binary).split(), capture_output=True)
-                    if not len(_x.stderr):
-                        _objdump = _x.stdout.decode('ascii').split('\n')
-                        _objdump = sorted(filter(lambda x: len(x), _objdump))
-                        _objdump = filter(lambda x: re.search('^0', x), _objdump)
-                        _objdump = map(lambda x: x.split(), _objdump)
-                        state.update({'objmap': {
-                            int(x[0], 16): {
-                                'flags': x[1:-1],
-                                'name': x[-1]
-                            } for x in _objdump
-                        }})
+                    state.update({'objmap': toolbox.elf.image(_binary)})
+                if state.get('config').get('trace_filename') and not state.get('trace'): state.update({'trace': toolbox.memtrace.Trace(state.get('config').get('trace_filename'))})
                 if not _mainmem.get('booted'): _mainmem.boot()
             elif {'text': 'pause'} == {k: v}:
                 state.update({'running': False})
@@ -499,22 +495,25 @@ if '__main__' == __name__:
                 _args = v.get('args')
                 if not _mainmem.get('booted'): _mainmem.boot()
                 _mainmem.loadbin(_coreid, _start_symbol, _sp, _pc, _binary, *_args)
+                if 'cmdline' in v.keys(): state.update({'cmdline': v.get('cmdline')}) # NOTE: what remains of the command line, i.e., not yet running on any core
             elif 'restore' == k:
                 assert not state.get('running'), 'Attempted restore while running!'
                 logging.info('restore : {}'.format(v))
                 _snapshot_filename = v.get('snapshot_filename')
                 if not _mainmem.get('booted'): _mainmem.boot()
                 _restore = _mainmem.restore(_snapshot_filename)
-                _regfile.registers = _restore.get('registers')
+                _core = _restore.get('cores').get(state.get('coreid'), {}) # NOTE: empty if this core was idle when the snapshot was taken
+                if _core: _regfile.registers = _core.get('registers')
 #                _regfile.update({'cycle': _restore.get('cycle')})
 #                _mainmem.update({'cycle': _restore.get('cycle')})
 #                state.update({'cycle': _restore.get('cycle')})
-                state.update({'instructions_committed': _restore.get('instructions_committed')})
+                state.update({'instructions_committed': _core.get('instructions_committed', 0)})
+                state.update({'cmdline': _restore.get('cmdline', [])})
                 logging.info('state.cycle : {}'.format(state.get('cycle')))
                 logging.info('state.instructions_committed : {}'.format(state.get('instructions_committed')))
                 logging.info('_mainmem.mmu.translations : {}'.format(_mainmem.mmu.translations))
                 logging.info('_regile.registers : {}'.format(_regfile.registers))
-                _service.tx({'ack': {'cycle': state.get('cycle')}})
+                _service.tx({'ack': {'cycle': state.get('cycle'), 'restore': {'cores': list(_restore.get('cores').keys()), 'cmdline': _restore.get('cmdline')}}})
             elif 'snapshots' == k:
                 state.update({'snapshots': v.get('checkpoints')})
                 state.update({'cmdline': v.get('cmdline')})
@@ -530,7 +529,12 @@ if '__main__' == __name__:
                         'cycle': state.get('cycle'),
                         'instructions_committed': state.get('instructions_committed'),
                         'cmdline': state.get('cmdline'),
-                        'registers': _regfile.registers,
+                        'cores': {
+                            state.get('coreid'): {
+                                'instructions_committed': state.get('instructions_committed'),
+                                'registers': _regfile.registers,
+                            },
+                        },
                     })
             elif 'register' == k:
                 logging.info('register : {}'.format(v))
@@ -11,6 +11,7 @@ import service
 import toolbox
 import toolbox.stats
 import simplecache
+import simplecache.mshr
 
 def fetch_block_0(service, state, coreid, addr, physical):
     _blockaddr = state.get('cache').blockaddr(addr)
@@ -182,8 +183,17 @@ def fetch_block(service, state, op):
 def do_cache(service, state, op):
     _data = state.get('cache').peek(op.get('addr'), op.get('size'))
     if not _data or state.get('cache').misc(op.get('addr')).get('coreid') != op.get('coreid'):
-        if 'blockaddr' not in op.keys(): fetch_block(service, state, op)
-        return ({**op, **{'blockaddr': state.get('cache').blockaddr(op.get('addr'))}} if 'blockaddr' not in op.keys() else op)
+        _blockaddr = state.get('cache').blockaddr(op.get('addr'))
+        _mshr = state.get('mshrs').allocate(
+            (op.get('coreid'), _blockaddr), # NOTE: blocks are per core, e.g., the same virtual address on two cores is two blocks
+            tuple(map(lambda x: op.get(x), ['addr', 'size', 'ante', 'post'])),
+        )
+        if 'primary' == _mshr: fetch_block(service, state, op)
+        if 'secondary' == _mshr: state.get('stats').refresh('flat', '{}_mshr_merges'.format(state.get('service')))
+        if not _mshr:
+            state.get('stats').refresh('flat', '{}_mshr_stalls'.format(state.get('service')))
+            return op
+        return ({**op, **{'blockaddr': _blockaddr}} if 'blockaddr' not in op.keys() else op)
     if op.get('data'):
         # POKE
         state.get('cache').poke(op.get('addr'), op.get('data'))
@@ -220,11 +230,11 @@ def do_tick(service, state, results, events):
         _addr = rs.get('addr')
         _data = rs.get('data')
         if not _data: continue
-        if any(map(lambda x: _addr == x.get('blockaddr'), state.get('executing'))):
-#        if any(map(lambda x: _addr == x.get('blockaddr') and _coreid == x.get('coreid'), state.get('executing'))):
+        if (_coreid, _addr) in state.get('mshrs'):
             service.tx({'info': 'rs : {}'.format(rs)})
             state.get('cache').poke(_addr, _data)
             state.get('cache').misc(_addr, {'coreid': _coreid})
+            state.get('mshrs').retire((_coreid, _addr))
     for _perf in map(lambda y: y.get('perf'), filter(lambda x: x.get('perf'), events)):
         _cmd = _perf.get('cmd')
         if 'report_stats' == _cmd:
@@ -273,6 +283,7 @@ def do_tick(service, state, results, events):
             state.update({'antepost': 1 + state.get('antepost')})
         service.tx({'info': 'state.executing : {}'.format(state.get('executing'))})
     state.update({'executing': list(map(lambda op: do_cache(service, state, op), state.get('executing')))})
+    state.get('stats').refresh('histo', '{}_mshr_occupancy'.format(state.get('service')), len(state.get('mshrs')))
     state.update({'executing': functools.reduce(
         lambda a, b: (a[:-1] + [fuse(a[-1], b)] if len(a) and fusable(a[-1], b) else a + [b]),
         state.get('executing'),
@@ -325,6 +336,7 @@ if '__main__' == __name__:
         'running': False,
         'ack': True,
         'executing': [],
+        'mshrs': None,
         'antepost': 0,
         'stats': None,
         'next': args.next,
@@ -335,6 +347,7 @@ if '__main__' == __name__:
             'nbytesperblock': 2**6,
             'evictionpolicy': 'lru',
             'hitlatency': 25,
+            'mshr_entries': 2**5,
         },
     }
     _service = service.Service(state.get('service'), state.get('coreid', -1), _launcher.get('host'), _launcher.get('port'))
@@ -350,6 +363,8 @@ if '__main__' == __name__:
             elif 'reset' == k:
                 _coreid = v.get('coreid')
                 state.update({'executing': list(filter(lambda x: _coreid != x.get('coreid'), state.get('executing')))})
+                if state.get('booted'):
+                    for _key in filter(lambda x: _coreid == x[0], list(state.get('mshrs').entries.keys())): state.get('mshrs').retire(_key)
 #                state.update({'pending_fetch': list(filter(lambda x: _coreid != x.get('coreid'), state.get('pending_fetch')))})
                 if state.get('booted'):
                     state.get('cache').invalidate(**{'misc': {'coreid': _coreid}})
@@ -362,6 +377,7 @@ if '__main__' == __name__:
                     state.update({'booted': True})
 #                    state.update({'pending_fetch': []})
                     state.update({'executing': []})
+                    state.update({'mshrs': simplecache.mshr.MSHRFile(state.get('config').get('mshr_entries'))})
                     state.update({'stats': toolbox.stats.CounterBank(state.get('coreid', -1), state.get('service'))})
                     state.update({'cache': simplecache.SimpleCache(
                         state.get('config').get('nsets'),
@@ -1,6 +1,6 @@
 # Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
 
-import random
+from ..simplecache import replacement
 
 class BTBEntry:
     def __init__(self, next_pc, counter_nbits=2):
@@ -14,45 +14,45 @@ class BTBEntry:
     def __repr__(self):
         return '[{} ; {} ; 0b{:04b}; {}]'.format(list((self.next_pc).to_bytes(8, 'little')), self.addr, self.counter, self.data)
 class SimpleBTB:
-    def __init__(self, nentries, nbytesperentry, evictionpolicy):
+    def __init__(self, nentries, nbytesperentry, evictionpolicy, seed=0):
         self.nentries = nentries
         self.nbytesperentry = nbytesperentry
         self.evictionpolicy = evictionpolicy
+        self.policy = replacement.policy(self.evictionpolicy, 1, self.nentries, seed) # NOTE: fully associative, i.e., one set of nentries ways
+        self.nfills = 0
         self.entries = [{
             'pc': None,
             'entry': BTBEntry(0),
+            'fill': -1,
         } for _ in range(self.nentries)]
     def waynum(self, pc):
         _way = list(filter(lambda x: pc == x.get('pc'), self.entries))
         assert len(_way) < 2, 'Multiple matching blocks?!?\n\t{}\n\t{}'.format(_way, self.entries)
         return (self.entries.index(_way.pop()) if len(_way) else None)
     def victim(self):
-        if 'random' == self.evictionpolicy:
-            return random.choice(list(range(self.nentries)))
-        if 'lru' == self.evictionpolicy:
-            self.entries.pop(-1)
-            self.entries.insert(0, {
-                'pc': None,
-                'entry': BTBEntry(0),
-            })
-            return 0
-        assert False, 'Unknown eviction policy: {}'.format(self.evictionpolicy)
+        _w = next(filter(lambda x: None == self.entries[x].get('pc'), range(self.nentries)), None) # NOTE: fill an empty entry before evicting any
+        _w = (_w if None != _w else self.policy.victim(0))
+        self.policy.fill(0, _w)
+        return _w
     def poke(self, pc, next_pc):
         if isinstance(self.waynum(pc), int): return
         self.entries[self.victim()] = {
             'pc': pc,
-            'entry': BTBEntry(next_pc)
+            'entry': BTBEntry(next_pc),
+            'fill': self.nfills,
         }
+        self.nfills += 1
     def peek(self, pc):
         _w = self.waynum(pc)
         return (self.entries[_w].get('entry') if isinstance(_w, int) else None)
     def update(self, next_pc, data):
         _w = list(filter(lambda x: next_pc == x.get('entry').addr, self.entries))
         if not len(_w): return
-        _w = self.entries.index(_w.pop())
+        _w = self.entries.index(min(_w, key=lambda x: x.get('fill')))
         # NOTE: It's theoretically possible, but unlikely, that more than one
         # BTB entry will have the same next_pc. I suppose I could extend both,
-        # but not dealing with that now... for now, just update the 0th entry
+        # but not dealing with that now... for now, just update the one that
+        # was filled earliest
         _entry = self.entries[_w].get('entry')
         _entry.data.extend(data)
         _entry.addr += len(data)
@@ -63,4 +63,6 @@ class SimpleBTB:
             self.entries[_w] = {
                 'pc': None,
                 'entry': BTBEntry(0),
-            }
\ No newline at end of file
+                'fill': -1,
+            }
+            self.policy.invalidate(0, _w)
\ No newline at end of file
@@ -1,7 +1,8 @@
 # Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
 
 import itertools
-import random
+
+from . import replacement # NOTE: relative, since this package is imported both as simplecache and as components.simplecache
 
 def log2(A):
     return (
@@ -11,94 +12,99 @@ def log2(A):
     )
 
 class SimpleCache:
-    def __init__(self, nsets, nways, nbytesperblock, evictionpolicy):
+    # The blocks of all sets are kept in flat arrays, indexed by
+    # (set * nways) + slot, and each set has a dict from tag to slot; which
+    # slot to replace is up to the replacement policy (see replacement.py)
+    def __init__(self, nsets, nways, nbytesperblock, evictionpolicy, seed=0):
         assert 0 == (nsets & (nsets - 1)), 'nset ({}) must be a power of 2'.format(nsets)
         assert 0 == (nbytesperblock & (nbytesperblock - 1)), 'nbyte ({}) must be a power of 2'.format(nbytesperblock)
         self.nsets = nsets
         self.nways = nways
         self.nbytesperblock = nbytesperblock
         self.evictionpolicy = evictionpolicy
-        self.sets = {}
+        self.seed = seed
+        self.offsetbits = log2(self.nbytesperblock)
+        self.offsetmask = self.nbytesperblock - 1
+        self.setmask = self.nsets - 1
+        self.tagshift = log2(self.nsets) + self.offsetbits
+        self.data = None  # NOTE: bytearray of nsets * nways * nbytesperblock bytes
+        self.tags = None  # NOTE: tag of each block, or None if invalid
+        self.dirty = None
+        self.miscs = None
+        self.index = None # NOTE: each set's {tag: slot}
+        self.owners = None # NOTE: {owner(misc): {block, ...}}, for invalidate()
+        self.policy = None
         self.purge()
     def purge(self):
-        self.sets = {
-            x: [
-                {
-                    'tag': None,
-                    'data': [0xff] * self.nbytesperblock,
-                    'dirty': False,
-                    'misc': {},
-                } for _ in range(self.nways)
-             ] for x in range(self.nsets)
-        }
+        self.data = bytearray(b'\xff' * (self.nsets * self.nways * self.nbytesperblock))
+        self.tags = [None] * (self.nsets * self.nways)
+        self.dirty = [False] * (self.nsets * self.nways)
+        self.miscs = [{} for _ in range(self.nsets * self.nways)]
+        self.index = [{} for _ in range(self.nsets)]
+        self.owners = {}
+        self.policy = replacement.policy(self.evictionpolicy, self.nsets, self.nways, self.seed)
+    def clear(self, s, w):
+        _b = (s * self.nways) + w
+        self.index[s].pop(self.tags[_b], None)
+        self.tags[_b] = None
+        self.data[_b * self.nbytesperblock:(1 + _b) * self.nbytesperblock] = b'\xff' * self.nbytesperblock
+        self.dirty[_b] = False
+        self.setmisc(_b, {})
+    def owner(self, misc): return tuple(sorted(misc.items()))
+    def setmisc(self, b, data):
+        if self.miscs[b]:
+            _blocks = self.owners.get(self.owner(self.miscs[b]))
+            _blocks.discard(b)
+            if not len(_blocks): self.owners.pop(self.owner(self.miscs[b]))
+        self.miscs[b] = data
+        if data: self.owners.setdefault(self.owner(data), set()).add(b)
     def invalidate(self, **kwargs):
         if kwargs.get('misc'):
-            _misc = kwargs.get('misc')
-            self.sets = {
-                x: [
-                    (y if _misc != y.get('misc') else {
-                        'tag': None,
-                        'data': [0xff] * self.nbytesperblock,
-                        'dirty': False,
-                        'misc': {},
-                    }) for y in self.sets[x]
-                ] for x in self.sets.keys()
-            }
-    def tag(self, addr): return (addr >> (log2(self.nsets) + log2(self.nbytesperblock)))
-    def setnum(self, addr): return (addr >> log2(self.nbytesperblock)) & ((1 << log2(self.nsets)) - 1)
-    def waynum(self, addr, s):
-        _way = list(filter(lambda w: s[w].get('tag') == self.tag(addr), range(self.nways)))
-        if not len(_way): return None
-        assert 1 == len(_way), 'Multiple tag matches among the ways?!?!? (@{:08x} {})'.format(addr, s)
-        return _way.pop()
-    def offset(self, addr): return (addr & ((1 << log2(self.nbytesperblock)) - 1))
+            for _b in sorted(self.owners.get(self.owner(kwargs.get('misc')), [])):
+                self.clear(_b // self.nways, _b % self.nways)
+                self.policy.invalidate(_b // self.nways, _b % self.nways)
+    def tag(self, addr): return (addr >> self.tagshift)
+    def setnum(self, addr): return (addr >> self.offsetbits) & self.setmask
+    def waynum(self, addr, s): return self.index[s].get(addr >> self.tagshift)
+    def offset(self, addr): return (addr & self.offsetmask)
     def fits(self, addr, nbytes):
         _offset = self.offset(addr)
         return (_offset + nbytes - 1) < self.nbytesperblock
     def blockaddr(self, addr):
-        return (addr >> log2(self.nbytesperblock)) << log2(self.nbytesperblock)
+        return (addr >> self.offsetbits) << self.offsetbits
     def victim(self, s):
-        if 'random' == self.evictionpolicy:
-            return random.choice(list(range(len(s))))
-        if 'lru' == self.evictionpolicy:
-            s.pop(-1)
-            s.insert(0, {
-                'tag': None,
-                'data': [0xff] * self.nbytesperblock,
-                'dirty': False,
-                'misc': {},
-            })
-            return 0
-        assert False, 'Unknown eviction policy: {}'.format(self.evictionpolicy)
+        # NOTE: an invalid way, if the set has one, is filled before any
+        #       valid block is evicted, whatever the policy
+        _w = (self.policy.victim(s) if self.nways == len(self.index[s]) else self.tags.index(None, s * self.nways, (1 + s) * self.nways) - (s * self.nways))
+        self.clear(s, _w)
+        self.policy.fill(s, _w)
+        return _w
     def peek(self, addr, nbytes):
-        _offset = self.offset(addr)
+        _offset = addr & self.offsetmask
         assert self.fits(addr, nbytes), 'request does not fit in block! ({:08x} {} {})'.format(addr, _offset, nbytes)
-        _set = self.sets[self.setnum(addr)]
-        _w = self.waynum(addr, _set)
-        _retval = None
-        if isinstance(_w, int):
-            _retval = _set[_w].get('data')[_offset:(_offset + nbytes)]
-            _set.insert(0, _set.pop(_w))
-        return _retval
+        _s = (addr >> self.offsetbits) & self.setmask
+        _w = self.index[_s].get(addr >> self.tagshift)
+        if None == _w: return None
+        self.policy.touch(_s, _w)
+        _x = (((_s * self.nways) + _w) * self.nbytesperblock) + _offset
+        return list(self.data[_x:_x + nbytes])
     def misc(self, addr, data=None):
-        _set = self.sets[self.setnum(addr)]
-        _w = self.waynum(addr, _set)
-        _retval = None
-        if isinstance(_w, int):
-            if data: _set[_w].update({'misc': data})
-            _retval = _set[_w].get('misc')
-        return _retval
+        _s = (addr >> self.offsetbits) & self.setmask
+        _w = self.index[_s].get(addr >> self.tagshift)
+        if None == _w: return None
+        _b = (_s * self.nways) + _w
+        if data: self.setmisc(_b, data)
+        return self.miscs[_b]
     def poke(self, addr, data):
-        _offset = self.offset(addr)
+        _offset = addr & self.offsetmask
         assert self.fits(addr, len(data)), 'request does not fit in block! ({:08x} {} {})'.format(addr, _offset, len(data))
-        _set = self.sets[self.setnum(addr)]
-        _w = self.waynum(addr, _set)
-        _w = (_w if isinstance(_w, int) else self.victim(_set))
-        _data = _set[_w].get('data')[:]
-        _data = _data[:_offset] + data + _data[_offset + len(data):]
-        _set[_w].update({
-            'tag': self.tag(addr),
-            'data': _data,
-            'dirty': True,
-            'misc': _set[_w].get('misc')
-        })
+        _s = (addr >> self.offsetbits) & self.setmask
+        _tag = addr >> self.tagshift
+        _w = self.index[_s].get(_tag)
+        _w = (_w if None != _w else self.victim(_s))
+        _b = (_s * self.nways) + _w
+        _x = (_b * self.nbytesperblock) + _offset
+        self.data[_x:_x + len(data)] = bytes(data)
+        self.tags[_b] = _tag
+        self.index[_s].update({_tag: _w})
+        self.dirty[_b] = True
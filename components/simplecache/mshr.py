@@ -0,0 +1,31 @@
+# Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
+
+# Miss status holding registers (MSHRs) for a cache that fetches blocks
+# from the next level in the memory hierarchy. Each entry is one block
+# being fetched and the accesses (waiters) waiting on it; a miss to a
+# block that already has an entry (i.e., a secondary miss) is merged into
+# that entry rather than fetched again, and a miss to any other block
+# waits until an entry is free.
+
+class MSHRFile:
+    def __init__(self, nentries):
+        assert 0 < nentries, 'nentries ({}) must be at least 1'.format(nentries)
+        self.nentries = nentries
+        self.entries = {} # NOTE: {key: [waiter, ...]}
+    def __len__(self): return len(self.entries)
+    def __contains__(self, key): return key in self.entries.keys()
+    def full(self): return self.nentries <= len(self.entries)
+    def allocate(self, key, waiter=None):
+        # return : 'primary' if key must now be fetched; 'secondary' if
+        #          key is already being fetched, and waiter has been merged
+        #          into its entry; 'pending' if waiter was already merged;
+        #          None if every entry is in use
+        if key in self.entries.keys():
+            if waiter in self.entries.get(key): return 'pending'
+            self.entries.get(key).append(waiter)
+            return 'secondary'
+        if self.full(): return None
+        self.entries.update({key: [waiter]})
+        return 'primary'
+    def retire(self, key): return self.entries.pop(key, [])
+    def clear(self): self.entries.clear()
@@ -0,0 +1,91 @@
+# Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
+
+# Replacement policies for set-associative structures (e.g., SimpleCache,
+# SimpleBTB) of nsets sets of nways ways each. A structure tells its policy
+# when a way is hit (touch()), filled (fill()) or invalidated
+# (invalidate()), and asks it for the way to be replaced (victim()); the
+# policy never moves ways around, so a way's contents stay put.
+
+import random
+
+class LRU:
+    # NOTE: each way holds the time it was last used; initially, way 0 is
+    #       the most recently used, and way nways-1 the least
+    def __init__(self, nsets, nways, seed=0):
+        self.nways = nways
+        self.clock = 1
+        self.stamps = [[-w for w in range(nways)] for _ in range(nsets)]
+    def touch(self, s, w):
+        self.stamps[s][w] = self.clock
+        self.clock += 1
+    def fill(self, s, w): self.touch(s, w)
+    def invalidate(self, s, w): pass
+    def victim(self, s):
+        _stamps = self.stamps[s]
+        return _stamps.index(min(_stamps))
+class PLRU:
+    # NOTE: tree pseudo-LRU; each set is nways-1 bits, in heap order, each
+    #       pointing (0: left, 1: right) toward the less recently used half
+    def __init__(self, nsets, nways, seed=0):
+        assert 0 == (nways & (nways - 1)), 'nways ({}) must be a power of 2 for plru'.format(nways)
+        self.nways = nways
+        self.bits = [[0] * max(1, nways - 1) for _ in range(nsets)]
+    def touch(self, s, w):
+        _bits = self.bits[s]
+        _x = 0
+        _n = self.nways
+        while 1 < _n:
+            _n >>= 1
+            _right = (w & _n)
+            _bits[_x] = (0 if _right else 1)
+            _x = (2 * _x) + (2 if _right else 1)
+    def fill(self, s, w): self.touch(s, w)
+    def invalidate(self, s, w): pass
+    def victim(self, s):
+        _bits = self.bits[s]
+        _x = 0
+        _w = 0
+        _n = self.nways
+        while 1 < _n:
+            _n >>= 1
+            if _bits[_x]: _w |= _n
+            _x = (2 * _x) + (2 if _bits[_x] else 1)
+        return _w
+class SRRIP:
+    # NOTE: static re-reference interval prediction (Jaleel et al., ISCA
+    #       2010) with 2-bit re-reference prediction values (RRPVs)
+    MAX = 3
+    def __init__(self, nsets, nways, seed=0):
+        self.nways = nways
+        self.rrpv = [[self.MAX] * nways for _ in range(nsets)]
+        self.random = random.Random(seed)
+    def touch(self, s, w): self.rrpv[s][w] = 0
+    def fill(self, s, w): self.rrpv[s][w] = self.MAX - 1
+    def invalidate(self, s, w): self.rrpv[s][w] = self.MAX
+    def victim(self, s):
+        _rrpv = self.rrpv[s]
+        _oldest = max(_rrpv)
+        if self.MAX > _oldest: self.rrpv[s] = _rrpv = list(map(lambda x: x + self.MAX - _oldest, _rrpv))
+        return _rrpv.index(self.MAX)
+class BRRIP(SRRIP):
+    # NOTE: bimodal RRIP; fills are predicted distant, except 1 in 32
+    def fill(self, s, w): self.rrpv[s][w] = (self.MAX - 1 if 0 == self.random.randrange(32) else self.MAX)
+class Random:
+    def __init__(self, nsets, nways, seed=0):
+        self.nways = nways
+        self.random = random.Random(seed)
+    def touch(self, s, w): pass
+    def fill(self, s, w): pass
+    def invalidate(self, s, w): pass
+    def victim(self, s): return self.random.randrange(self.nways)
+
+POLICIES = {
+    'lru': LRU,
+    'plru': PLRU,
+    'srrip': SRRIP,
+    'brrip': BRRIP,
+    'random': Random,
+}
+def policy(name, nsets, nways, seed=0):
+    assert name in POLICIES.keys(), 'Unknown eviction policy: {}'.format(name)
+    return POLICIES.get(name)(nsets, nways, seed)
@@ -11,10 +11,9 @@ import subprocess
 import itertools
 import json
 
-import elftools.elf.elffile
-
 import service
 import toolbox
+import toolbox.elf
 import toolbox.stats
 import simplemmu
 
@@ -25,13 +24,71 @@ def log2(A):
         len(list(itertools.takewhile(lambda x: x, map(lambda y: A >> y, range(A))))) - 1
     )
 
+class SparseMemory:
+    # Main memory that holds only the pages that have been written to, for
+    # use in place of an mmap of a capacity-sized file; supports the subset
+    # of mmap's interface that SimpleMainMemory uses, i.e., slicing
+    def __init__(self, capacity, pagesize):
+        self.capacity = capacity
+        self.pagesize = pagesize
+        self.pages = {} # NOTE: page-aligned address -> bytearray of pagesize bytes
+        self.base = {}  # NOTE: page-aligned address -> (read-only mapping, offset) of a page not yet written to
+        self.mappings = {}
+    def __len__(self): return self.capacity
+    def __getitem__(self, key):
+        _start, _stop, _ = key.indices(self.capacity)
+        _retval = bytearray()
+        while _start < _stop:
+            _page = _start - (_start % self.pagesize)
+            _end = min(_stop, _page + self.pagesize)
+            _data = self.pages.get(_page)
+            if None != _data:
+                _retval += _data[_start - _page:_end - _page]
+            elif _page in self.base:
+                _m, _offset = self.base.get(_page)
+                _retval += _m[_offset + _start - _page:_offset + _end - _page]
+            else:
+                _retval += bytes(_end - _start)
+            _start = _end
+        return bytes(_retval)
+    def __setitem__(self, key, data):
+        _start, _stop, _ = key.indices(self.capacity)
+        if _stop - _start != len(data): raise IndexError('SparseMemory slice assignment is wrong size')
+        _x = 0
+        while _start < _stop:
+            _page = _start - (_start % self.pagesize)
+            _end = min(_stop, _page + self.pagesize)
+            _data = self.pages.get(_page)
+            if None == _data:
+                _data = (bytearray(self[_page:_page + self.pagesize]) if _page in self.base else bytearray(self.pagesize)) # NOTE: copy on write
+                self.pages.update({_page: _data})
+            _data[_start - _page:_end - _page] = data[_x:_x + _end - _start]
+            _x += _end - _start
+            _start = _end
+    def drop(self, page): # NOTE: the page then reads as zeros
+        self.pages.pop(page, None)
+        self.base.pop(page, None)
+    def map(self, filename):
+        if filename not in self.mappings:
+            with open(filename, 'rb') as fp: self.mappings.update({filename: mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)})
+        return self.mappings.get(filename)
+    def flush(self): pass
+    def close(self):
+        self.pages.clear()
+        self.base.clear()
+        for m in self.mappings.values(): m.close()
+        self.mappings.clear()
 class SimpleMainMemory:
+    SNAPSHOT_MAGIC = b'nebula.snapshot\n'
     DEFAULT = {
         'pagesize': 2**16,
         'filename': '/tmp/mainmem.raw',
         'capacity': 2**32,
         'peek_latency_in_cycles': 10**3,
         'v2p_latency_in_cycles': 10**2,
+        'tlb_entries': 2**6,
+        'backend': 'mmap',
+        'restore_mode': 'copy',
     }
     def __init__(self, name, launcher, s=None, **kwargs):
         self.name = name
@@ -42,10 +99,18 @@ class SimpleMainMemory:
             'capacity': kwargs.get('capacity', self.DEFAULT.get('capacity')),
             'peek_latency_in_cycles': kwargs.get('peek_latency_in_cycles', self.DEFAULT.get('peek_latency_in_cycles')),
             'v2p_latency_in_cycles': kwargs.get('v2p_latency_in_cycles', self.DEFAULT.get('v2p_latency_in_cycles')),
+            'tlb_entries': kwargs.get('tlb_entries', self.DEFAULT.get('tlb_entries')),
+            'backend': kwargs.get('backend', self.DEFAULT.get('backend')),
+            'restore_mode': kwargs.get('restore_mode', self.DEFAULT.get('restore_mode')),
         }
         self.pageoffsetmask = None
         self.pageoffsetbits = None
         self.mmu = None
+        self.tlb = None
+        self.tlb_hits = 0
+        self.tlb_misses = 0
+        self.zeros = None
+        self.debug = False
         self.cycle = 0
         self.active = True
         self.running = False
@@ -54,34 +119,38 @@ class SimpleMainMemory:
         self.fd = None
         self.mm = None
         self.snapshots = None
+        self.snapshot_base = None # NOTE: the snapshot the next snapshot is a delta from
+        self.dirty = set()        # NOTE: frames written to since snapshot_base
         self.stats = toolbox.stats.CounterBank(self.get('coreid', -1), name)
     def boot(self):
         assert 0 == (self.config.get('pagesize') & (self.config.get('pagesize') - 1)), 'pagesize ({}) is not power of 2!'.format(self.config.get('pagesize'))
         self.pageoffsetmask = self.config.get('pagesize') - 1
         self.pageoffsetbits = log2(self.config.get('pagesize'))
-        self.mmu = simplemmu.SimpleMMU(self.config.get('pagesize'))
-        self.fd = os.open(self.config.get('filename'), os.O_RDWR|os.O_CREAT)
-        os.ftruncate(self.get('fd'), self.config.get('capacity'))
-        self.mm = mmap.mmap(self.fd, self.config.get('capacity'))
+        assert 0 < self.config.get('tlb_entries') and 0 == (self.config.get('tlb_entries') & (self.config.get('tlb_entries') - 1)), 'tlb_entries ({}) is not power of 2!'.format(self.config.get('tlb_entries'))
+        self.debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        self.mmu = simplemmu.SimpleMMU(self.config.get('pagesize'), debug=self.debug)
+        self.tlb = [None] * self.config.get('tlb_entries')
+        self.zeros = bytes(self.config.get('pagesize'))
+        assert self.config.get('backend') in ['mmap', 'sparse'], 'Unknown backend ({})!'.format(self.config.get('backend'))
+        if 'sparse' == self.config.get('backend'):
+            # NOTE: no file backs main memory, so nothing is written to disk
+            #       unless a snapshot is taken
+            self.mm = SparseMemory(self.config.get('capacity'), self.config.get('pagesize'))
+        else:
+            self.fd = os.open(self.config.get('filename'), os.O_RDWR|os.O_CREAT)
+            os.ftruncate(self.get('fd'), self.config.get('capacity'))
+            self.mm = mmap.mmap(self.fd, self.config.get('capacity'))
         self.update({'booted': True})
     def loadbin(self, coreid, start_symbol, sp, pc, binary, *args):
         logging.info('loadbin(): binary : {} ({})'.format(binary, type(binary)))
         logging.info('loadbin(): args   : {} ({})'.format(args, type(args)))
         logging.info('loadbin(): coreid : {} ({})'.format(coreid, type(coreid)))
         _start_pc = pc
-        with open(binary, 'rb') as fp:
-            elffile = elftools.elf.elffile.ELFFile(fp)
-            for section in filter(lambda x: x.header.sh_addr, elffile.iter_sections()):
-                if not section: continue
-                _addr = pc + section.header.sh_addr
-                logging.info('loadbin(): {} : 0x{:08x} ({})'.format(section.name, _addr, section.data_size))
-                self.poke(_addr, section.data_size, section.data(), **{'coreid': coreid}) # FIXME: this assumes each section will be less than self.pagesize bytes
-            _symbol_tables = [s for s in elffile.iter_sections() if isinstance(s, elftools.elf.elffile.SymbolTableSection)]
-            _start = sum([list(filter(lambda s: start_symbol == s.name, tab.iter_symbols())) for tab in _symbol_tables], [])
-            assert 0 < len(_start), 'No {} symbol!'.format(start_symbol)
-            assert 2 > len(_start), 'More than one {} symbol?!?!?!?'.format(start_symbol)
-            _start = next(iter(_start))
-            _start_pc = pc + _start.entry.st_value
+        for section in toolbox.elf.image(binary).get('sections'):
+            _addr = pc + section.get('addr')
+            logging.info('loadbin(): {} : 0x{:08x} ({})'.format(section.get('name'), _addr, section.get('size')))
+            self.poke(_addr, section.get('size'), section.get('data'), **{'coreid': coreid}) # FIXME: this assumes each section will be less than self.pagesize bytes
+        _start_pc = pc + toolbox.elf.symbol(binary, start_symbol)
         # The value of the argc argument is the number of command line
         # arguments. The argv argument is a vector of C strings; its elements
         # are the individual command line argument strings. The file name of
@@ -112,46 +181,159 @@ class SimpleMainMemory:
         self.poke(sp + (2+len(_addr))*8, 8, bytes(''.join(_args), 'ascii'), **{'coreid': coreid})
         return _start_pc
     def snapshot(self, data):
+        # A snapshot holds only the frames written to since the previous
+        # snapshot (or restore), and names that snapshot as its base; so a
+        # snapshot is the chain of deltas from it back to the first one. The
+        # file is SNAPSHOT_MAGIC, the length of the JSON-encoded state, the
+        # state, then one page per frame in state['snapshot']['frames'].
         logging.info('snapshot(): data   : {}'.format(data))
         _snapshot_filename = '{}.{:015}.snapshot'.format(self.get('config').get('filename'), data.get('instructions_committed'))
-        subprocess.run('cp {} {}'.format(self.get('config').get('filename'), _snapshot_filename).split())
+        _pagesize = self.config.get('pagesize')
+        _frames = sorted(self.dirty)
         _state = json.dumps({
             **data,
             **{
                 'mmu': self.mmu.translations,
+                'snapshot': {
+                    'pagesize': _pagesize,
+                    'base': (os.path.relpath(self.snapshot_base, os.path.dirname(os.path.abspath(_snapshot_filename))) if self.snapshot_base else None),
+                    'frames': _frames,
+                },
             },
         })
         logging.info('snapshot(): mmu    : {}'.format(self.mmu.translations))
         logging.info('snapshot(): _state : {}'.format(_state))
-        fd = os.open(_snapshot_filename, os.O_RDWR | os.O_CREAT)
-        os.lseek(fd, self.config.get('capacity'), os.SEEK_SET)
-        os.write(fd, len(_state).to_bytes(8, 'little'))
-        os.write(fd, bytes(_state, encoding='ascii'))
-        os.fsync(fd)
-        os.close(fd)
-        logging.info('snapshot(): snapshot saved to {}'.format(_snapshot_filename))
+        with open(_snapshot_filename, 'wb') as fp:
+            fp.write(self.SNAPSHOT_MAGIC)
+            fp.write(len(_state).to_bytes(8, 'little'))
+            fp.write(bytes(_state, encoding='ascii'))
+            for f in _frames: fp.write(self.mm[f:f + _pagesize])
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.dirty = set()
+        self.snapshot_base = os.path.abspath(_snapshot_filename)
+        logging.info('snapshot(): snapshot saved to {} ({} frames)'.format(_snapshot_filename, len(_frames)))
         # FIXME: make snapshots read-only after creation
         return _snapshot_filename
+    def snapshot_state(self, snapshot_filename):
+        # return : (state, offset of the first page) of a snapshot, or
+        # (state, None) for a snapshot in the original format, i.e., a copy
+        # of the whole mainmem file with the state appended at capacity
+        with open(snapshot_filename, 'rb') as fp:
+            _original = self.SNAPSHOT_MAGIC != fp.read(len(self.SNAPSHOT_MAGIC))
+            if _original: fp.seek(self.config.get('capacity'))
+            _state_length = int.from_bytes(fp.read(8), 'little')
+            _retval = json.loads(str(fp.read(_state_length), encoding='ascii'))
+            return _retval, (None if _original else fp.tell())
+    def snapshot_frames(self, snapshot_filename, state, offset):
+        # return : {frame: (snapshot filename, offset of page)} for each frame
+        # the MMU maps, taken from the newest snapshot in the chain of deltas
+        # from snapshot_filename back to the first snapshot that has it
+        _pagesize = self.config.get('pagesize')
+        _pending = set(self.mmu.frames.keys())
+        _retval = {}
+        _filename = snapshot_filename
+        while len(_pending) and _filename:
+            for x, f in enumerate(state.get('snapshot').get('frames')):
+                if f not in _pending: continue
+                _retval.update({f: (_filename, offset + (x * _pagesize))})
+                _pending.remove(f)
+            _base = state.get('snapshot').get('base')
+            _filename = (os.path.join(os.path.dirname(os.path.abspath(_filename)), _base) if _base else None)
+            if _filename: state, offset = self.snapshot_state(_filename)
+        return _retval
     def restore(self, snapshot_filename):
-        subprocess.run('cp {} {}'.format(snapshot_filename, self.get('config').get('filename')).split())
-        subprocess.run('chmod u+w {}'.format(self.get('config').get('filename')).split())
-        fd = os.open(snapshot_filename, os.O_RDONLY)
-        os.lseek(fd, self.config.get('capacity'), os.SEEK_SET)
-        _state_length = int.from_bytes(os.read(fd, 8), 'little')
-        _retval = str(os.read(fd, _state_length), encoding='ascii')
-        _retval = json.loads(_retval)
-        _retval.update({'registers': {(k if '%pc' == k else int(k)):v for k, v in _retval.get('registers').items()}})
+        _retval, _offset = self.snapshot_state(snapshot_filename)
+        if 'cores' not in _retval.keys():
+            # NOTE: a snapshot from before multi-core snapshots holds only
+            #       core 0's registers, and the whole command line
+            _retval.update({
+                'cores': {0: {'instructions_committed': _retval.get('instructions_committed'), 'registers': _retval.get('registers')}},
+                'cmdline': [],
+            })
+        _retval.update({'cores': {int(c): {**x, **{'registers': {(k if '%pc' == k else int(k)):v for k, v in x.get('registers').items()}}} for c, x in _retval.get('cores').items()}})
         _retval.update({'mmu': {int(x):y for x, y in _retval.get('mmu').items()}})
-        self.mmu.translations = _retval.get('mmu')
-        os.close(fd)
-        for k, v in _retval.get('registers').items(): self.service.tx({'register': {
-            'coreid': 0, # TODO: allow restore of multi-core snapshots
-            'cmd': 'set',
-            'name': k,
-            'data': v,
-        }})
+        self.mmu.load(_retval.get('mmu'))
+        self.tlb = [None] * len(self.tlb)
+        _pagesize = self.config.get('pagesize')
+        assert self.config.get('restore_mode') in ['copy', 'cow'], 'Unknown restore_mode ({})!'.format(self.config.get('restore_mode'))
+        if None != _offset: assert _pagesize == _retval.get('snapshot').get('pagesize'), 'Snapshot pagesize ({}) does not match mainmem:pagesize ({})!'.format(_retval.get('snapshot').get('pagesize'), _pagesize)
+        if 'cow' == self.config.get('restore_mode'):
+            # NOTE: map the snapshot rather than copy it, so that nothing is
+            #       read until it is touched, writes stay private to this run,
+            #       and runs restored from the same snapshot share its pages
+            #       in the page cache
+            self.mm.close()
+            if None != self.fd: os.close(self.fd)
+            self.fd = None
+            if None == _offset:
+                with open(snapshot_filename, 'rb') as fp: self.mm = mmap.mmap(fp.fileno(), self.config.get('capacity'), access=mmap.ACCESS_COPY)
+            else:
+                self.mm = SparseMemory(self.config.get('capacity'), _pagesize)
+                for f, (x, y) in self.snapshot_frames(snapshot_filename, _retval, _offset).items(): self.mm.base.update({f: (self.mm.map(x), y)})
+        elif None == _offset:
+            if isinstance(self.mm, SparseMemory):
+                # NOTE: only frames the MMU has handed out can hold data
+                self.mm.close()
+                fd = os.open(snapshot_filename, os.O_RDONLY)
+                for f in self.mmu.frames.keys():
+                    _data = os.pread(fd, _pagesize, f)
+                    if any(_data): self.mm[f:f + len(_data)] = _data
+                os.close(fd)
+            else:
+                subprocess.run('cp {} {}'.format(snapshot_filename, self.get('config').get('filename')).split())
+                subprocess.run('chmod u+w {}'.format(self.get('config').get('filename')).split())
+        else:
+            if isinstance(self.mm, SparseMemory): self.mm.close()
+            _frames = self.snapshot_frames(snapshot_filename, _retval, _offset)
+            _fds = {x: os.open(x, os.O_RDONLY) for x in set(map(lambda z: z[0], _frames.values()))}
+            for f in self.mmu.frames.keys():
+                if f in _frames.keys():
+                    x, y = _frames.get(f)
+                    self.mm[f:f + _pagesize] = os.pread(_fds.get(x), _pagesize, y)
+                elif not isinstance(self.mm, SparseMemory):
+                    self.mm[f:f + _pagesize] = bytes(_pagesize) # NOTE: never written to before the first snapshot
+            for fd in _fds.values(): os.close(fd)
+        # NOTE: a snapshot in the original format cannot be a base, so the
+        #       next snapshot must hold every frame the MMU maps
+        self.dirty = (set(self.mmu.frames.keys()) if None == _offset else set())
+        self.snapshot_base = (os.path.abspath(snapshot_filename) if None != _offset else None)
+        for c, x in _retval.get('cores').items():
+            for k, v in x.get('registers').items(): self.service.tx({'register': {
+                'coreid': c,
+                'cmd': 'set',
+                'name': k,
+                'data': v,
+            }})
         logging.info('SimpleMainMemory.restore(): _retval : {}'.format(_retval))
         return _retval
+    def translate(self, addr, coreid):
+        # NOTE: a direct-mapped cache of (coreid, virtual page) -> physical
+        #       frame in front of the MMU; purge() must be used in place of
+        #       mmu.purge() to keep the two consistent
+        _vframe = addr & ~self.pageoffsetmask
+        _x = ((_vframe >> self.pageoffsetbits) ^ coreid) & (len(self.tlb) - 1)
+        _entry = self.tlb[_x]
+        if _entry and _vframe == _entry[0] and coreid == _entry[1]:
+            self.tlb_hits += 1
+            return _entry[2] | (addr & self.pageoffsetmask)
+        self.tlb_misses += 1
+        _addr = self.mmu.translate(addr, coreid)
+        self.tlb[_x] = (_vframe, coreid, _addr & ~self.pageoffsetmask)
+        return _addr
+    def purge(self, coreid):
+        self.mmu.purge(coreid)
+        self.tlb = [(None if x and coreid == x[1] else x) for x in self.tlb]
+    def zero_frames(self, frames):
+        # NOTE: whole frames are zeroed at once, rather than poke()'d; the
+        #       sparse backend simply forgets them
+        _pagesize = self.config.get('pagesize')
+        for f in frames:
+            if isinstance(self.mm, SparseMemory):
+                self.mm.drop(f)
+            else:
+                self.mm[f:f + _pagesize] = self.zeros
+            self.dirty.add(f)
     def state(self):
         return {
             'cycle': self.get('cycle'),
@@ -166,6 +348,7 @@ class SimpleMainMemory:
         for _perf in map(lambda y: y.get('perf'), filter(lambda x: x.get('perf'), events)):
             _cmd = _perf.get('cmd')
             if 'report_stats' == _cmd:
+                self.stats.refresh('dict', 'tlb', {'hits': self.tlb_hits, 'misses': self.tlb_misses})
                 _dict = self.stats.get(self.state().get('coreid')).get(self.state().get('service'))
                 toolbox.report_stats_from_dict(self.service, self.state(), _dict)
         for _coreid, ev in map(lambda x: (x.get('coreid'), x.get('mem')), filter(lambda y: 'mem' in y.keys(), events)):
@@ -199,7 +382,7 @@ class SimpleMainMemory:
             _cmd = ev.get('cmd')
             _vaddr = ev.get('vaddr')
             if 'purge' == _cmd:
-                self.mmu.purge(_coreid)
+                self.purge(_coreid)
             elif 'v2p' == _cmd:
                 _paddr = self.mmu.translate(_vaddr, _coreid)
                 self.service.tx({'result': {
@@ -217,12 +400,14 @@ class SimpleMainMemory:
         return retval
     def do_poke(self, addr, data, **kwargs):
         # data : list of unsigned char, e.g., to make an integer, X, into a list
-        # of N little-endian-formatted bytes -> list(X.to_bytes(N, 'little'))
+        # of N little-endian-formatted bytes -> list(X.to_bytes(N, 'little')),
+        # or any bytes-like object (e.g., bytes, bytearray, memoryview)
         assert isinstance(kwargs.get('coreid'), int)
-        _addr = (self.mmu.translate(addr, kwargs.get('coreid')) if not kwargs.get('physical') else addr)
-        logging.debug('do_poke({:08x}, ..., {}) -> {:08x}'.format(addr, kwargs, _addr))
+        _addr = (self.translate(addr, kwargs.get('coreid')) if not kwargs.get('physical') else addr)
+        if self.debug: logging.debug('do_poke({:08x}, ..., {}) -> {:08x}'.format(addr, kwargs, _addr))
         try:
-            self.mm[_addr:_addr+len(data)] = bytes(data) 
+            self.mm[_addr:_addr+len(data)] = (bytes(data) if isinstance(data, list) else data)
+            self.dirty.add(_addr & ~self.pageoffsetmask)
         except:
             pass # FIXME: Something other than ignoring the issue should happen here!
     def poke(self, addr, size, data, **kwargs):
@@ -240,22 +425,22 @@ class SimpleMainMemory:
             logging.debug('poke.accesses(): _addrs : ({}) {}'.format(kwargs.get('coreid'), '[{}]'.format(', '.join(map(lambda x: '{:08x}'.format(x), _addrs)))))
             return zip(_addrs, _datas)
         assert isinstance(kwargs.get('coreid'), int)
-        logging.debug('poke({:08x}, {}, ..., {})'.format(addr, size, kwargs))
+        if self.debug: logging.debug('poke({:08x}, {}, ..., {})'.format(addr, size, kwargs))
         if not self.valid_access(addr, size):
             logging.info('poke({:08}, {}, ..., {}): Access does not fit in memory boundaries!'.format(addr, size, kwargs))
             return
+        if (addr ^ (addr + len(data))) <= self.pageoffsetmask: return self.do_poke(addr, data, **kwargs) # NOTE: the common case, an access within one page
         for a, d in accesses(addr, len(data), data, **kwargs): self.do_poke(a, d, **kwargs)
-    def do_peek(self, addr, size, **kwargs):
-        # return : list of unsigned char, e.g., to make an 8-byte quadword from
-        # a list, X, of N bytes -> int.from_bytes(X, 'little')
+    def do_peek_into(self, addr, buf, **kwargs):
+        # buf : writable bytes-like object (e.g., bytearray, memoryview) to be
+        # filled with len(buf) bytes; return : number of bytes actually read
         assert isinstance(kwargs.get('coreid'), int)
-        _addr = (self.mmu.translate(addr, kwargs.get('coreid')) if not kwargs.get('physical') else addr)
-        logging.debug('do_peek({:08x}, {}, {}) -> {:08x}'.format(addr, size, kwargs, _addr))
-        try:
-            return list(self.mm[_addr:_addr + size])
-        except:
-            return []
-    def peek(self, addr, size, **kwargs):
+        _addr = (self.translate(addr, kwargs.get('coreid')) if not kwargs.get('physical') else addr)
+        if self.debug: logging.debug('do_peek_into({:08x}, {}, {}) -> {:08x}'.format(addr, len(buf), kwargs, _addr))
+        _data = self.mm[_addr:_addr + len(buf)]
+        buf[:len(_data)] = _data
+        return len(_data)
+    def peek_into(self, addr, buf, **kwargs):
         def accesses(addr, size, **kwargs):
             _pagesize = self.config.get('pagesize')
             if simplemmu.frame(_pagesize, addr) == simplemmu.frame(_pagesize, addr + size): return zip([addr], [size])
@@ -266,12 +451,25 @@ class SimpleMainMemory:
                 _sizes += [min(_pagesize, size - sum(_sizes))]
             return zip(_addrs, _sizes)
         assert isinstance(kwargs.get('coreid'), int)
-        logging.debug('peek({:08x}, {}, ..., {})'.format(addr, size, kwargs))
-        if not self.valid_access(addr, size):
-            logging.info('peek({:08}, {}, ..., {}): Access does not fit in memory boundaries!'.format(addr, size, kwargs))
-            return []
-        return sum([self.do_peek(a, s, **kwargs) for a, s in accesses(addr, size, **kwargs)], [])
-
+        _size = len(buf)
+        if self.debug: logging.debug('peek_into({:08x}, {}, ..., {})'.format(addr, _size, kwargs))
+        if not self.valid_access(addr, _size):
+            logging.info('peek_into({:08}, {}, ..., {}): Access does not fit in memory boundaries!'.format(addr, _size, kwargs))
+            return 0
+        if (addr ^ (addr + _size)) <= self.pageoffsetmask: return self.do_peek_into(addr, buf, **kwargs) # NOTE: the common case, an access within one page
+        _retval = 0
+        with memoryview(buf) as _buf:
+            for a, s in accesses(addr, _size, **kwargs):
+                _n = self.do_peek_into(a, _buf[_retval:_retval + s], **kwargs)
+                _retval += _n
+                if _n < s: break
+        return _retval
+    def peek(self, addr, size, **kwargs):
+        # NOTE: for messages to other services, which carry lists of ints;
+        #       peek_into() avoids allocating anything but the caller's buffer
+        _buf = bytearray(size)
+        _n = self.peek_into(addr, _buf, **kwargs)
+        return list(_buf if _n == size else _buf[:_n])
 
 if '__main__' == __name__:
     parser = argparse.ArgumentParser(description='Nebula: Main Memory')
@@ -282,6 +480,9 @@ if '__main__' == __name__:
     parser.add_argument('--capacity', type=int, dest='capacity', default=2**32, help='size (in bytes) of main memory file')
     parser.add_argument('--peek_latency_in_cycles', type=int, dest='peek_latency_in_cycles', default=10**3, help='# of cycles to return peek result')
     parser.add_argument('--v2p_latency_in_cycles', type=int, dest='v2p_latency_in_cycles', default=10**2, help='# of cycles to return MMU result')
+    parser.add_argument('--backend', type=str, dest='backend', default='mmap', choices=['mmap', 'sparse'], help='mmap a capacity-sized file, or keep only touched pages in memory')
+    parser.add_argument('--restore_mode', type=str, dest='restore_mode', default='copy', choices=['copy', 'cow'], help='copy a snapshot into main memory, or map it copy-on-write')
+    parser.add_argument('--tlb_entries', type=int, dest='tlb_entries', default=2**6, help='# of entries in the (direct-mapped) translation cache in front of the MMU')
     parser.add_argument('launcher', help='host:port of Nebula launcher')
     args = parser.parse_args()
     assert not os.path.isfile(args.log), '--log must point to directory, not file'
@@ -305,6 +506,9 @@ if '__main__' == __name__:
         'capacity': args.capacity,
         'peek_latency_in_cycles': args.peek_latency_in_cycles,
         'v2p_latency_in_cycles': args.v2p_latency_in_cycles,
+        'tlb_entries': args.tlb_entries,
+        'backend': args.backend,
+        'restore_mode': args.restore_mode,
     })
     while state.get('active'):
         state.update({'ack': True})
@@ -320,9 +524,8 @@ if '__main__' == __name__:
                 logging.info('@{:15} : {}'.format(state.get('cycle'), msg))
                 if state.get('booted'):
                     logging.info('@{:15} : state.mmu.translations : {}'.format(state.get('cycle'), state.mmu.get('translations')))
-                    _pagesize = state.get('config').get('pagesize')
-                    for f in state.mmu.pframes(_coreid): state.poke(f, _pagesize, [0] * _pagesize, **{'coreid': _coreid, 'physical': True})
-                    state.mmu.purge(_coreid)
+                    state.zero_frames(state.mmu.pframes(_coreid))
+                    state.purge(_coreid)
             elif {'text': 'run'} == {k: v}:
                 logging.info('state.config : {}'.format(state.get('config')))
                 if not state.get('booted'): state.boot()
@@ -346,14 +549,14 @@ if '__main__' == __name__:
                 _binary = v.get('binary')
                 _args = v.get('args')
                 if not state.get('booted'): state.boot()
-                state.mmu.purge(_coreid)
+                state.purge(_coreid)
                 logging.info('@{:15} : state.mmu.translations : {}'.format(state.get('cycle'), state.mmu.get('translations')))
                 state.loadbin(_coreid, _start_symbol, _sp, _pc, _binary, *_args)
             elif 'restore' == k:
                 _snapshot_filename = v.get('snapshot_filename')
                 if not state.get('booted'): state.boot()
-                state.restore(_snapshot_filename)
-                state.service.tx({'ack': {'cycle': state.get('cycle')}})
+                _restore = state.restore(_snapshot_filename)
+                state.service.tx({'ack': {'cycle': state.get('cycle'), 'restore': {'cores': list(_restore.get('cores').keys()), 'cmdline': _restore.get('cmdline')}}})
             elif 'snapshots' == k:
                 state.update({'snapshots': v})
             elif 'tick' == k:
@@ -368,5 +571,5 @@ if '__main__' == __name__:
         if state.get('ack') and state.get('running'): state.service.tx({'ack': {'cycle': state.get('cycle'), 'msg': msg}})
     state.get('mm').flush()
     state.get('mm').close()
-    os.close(state.get('fd'))
+    if None != state.get('fd'): os.close(state.get('fd'))
     logging.info('state.mmu.translations : {}'.format(json.dumps(state.get('mmu').get('translations'), indent=4)))
\ No newline at end of file
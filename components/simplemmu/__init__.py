@@ -1,6 +1,7 @@
 # Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
 
 import itertools
+import heapq
 
 def log2(A):
     return (
@@ -13,27 +14,56 @@ def frame(pagesize, addr): return ((addr | (pagesize - 1)) ^ (pagesize - 1))
 
 class SimpleMMU:
     BASE = 0x1000_0000
-    def __init__(self, pagesize):
+    def __init__(self, pagesize, debug=False):
         assert 0 == (pagesize & (pagesize - 1)), 'pagesize must be a power of 2!'
         self.pagesize = pagesize
+        self.pagebits = log2(pagesize)
+        self.debug = debug # NOTE: check for shared physical frames on every translate()
         self.translations = {}
+        # NOTE: a frame is allocated from the pool of frames freed by purge()
+        #       if any, else from just past the highest frame ever allocated,
+        #       so the lowest-numbered free frame is always the one allocated
+        self.free = []
+        self.top = 0
+        self.frames = {}  # NOTE: frame -> key into self.translations
+        self.coreids = {} # NOTE: coreid -> {key into self.translations: None}
     def offset(self, addr): return offset(self.pagesize, addr)
     def frame(self, addr): return frame(self.pagesize, addr)
-    def pframes(self, coreid): return list(map(lambda y: y.get('frame'), filter(lambda x: coreid == x.get('coreid'), self.translations.values())))
+    def pframes(self, coreid): return list(map(lambda x: self.translations.get(x).get('frame'), self.coreids.get(coreid, {}).keys()))
+    def allocate(self):
+        if len(self.free): return self.BASE + (heapq.heappop(self.free) << self.pagebits)
+        self.top += 1
+        return self.BASE + ((self.top - 1) << self.pagebits)
+    def insert(self, k, v):
+        self.translations.update({k: v})
+        self.frames.update({v.get('frame'): k})
+        self.coreids.setdefault(v.get('coreid'), {}).update({k: None})
     def translate(self, addr, coreid):
         _k = frame(self.pagesize, addr) | coreid
-        self.translations.update({_k: self.translations.get(_k, {
-#            'frame': self.BASE + (len(self.translations.keys()) << log2(self.pagesize)),
-            'frame': next(filter(
-                lambda x: x not in map(lambda y: y.get('frame'), self.translations.values()),
-                map(lambda z: self.BASE + (z << log2(self.pagesize)), range(len(self.translations.keys())))
-            ), self.BASE + (len(self.translations.keys()) << log2(self.pagesize))),
-            'coreid': coreid,
-        })})
-        assert len(list(map(lambda x: x.get('frame'), self.translations.values()))) == len(set(map(lambda x: x.get('frame'), self.translations.values()))), 'Shared physical frame! {}'.format(self.translations)
-        return self.translations.get(_k).get('frame') | offset(self.pagesize, addr)
+        _v = self.translations.get(_k)
+        if None == _v:
+            _v = {
+                'frame': self.allocate(),
+                'coreid': coreid,
+            }
+            self.insert(_k, _v)
+        if self.debug: assert len(self.translations) == len(set(map(lambda x: x.get('frame'), self.translations.values()))), 'Shared physical frame! {}'.format(self.translations)
+        return _v.get('frame') | offset(self.pagesize, addr)
     def purge(self, coreid):
-        self.translations = {k:v for k, v in self.translations.items() if coreid != v.get('coreid')}
+        for _k in self.coreids.pop(coreid, {}).keys():
+            _frame = self.translations.pop(_k).get('frame')
+            self.frames.pop(_frame)
+            heapq.heappush(self.free, (_frame - self.BASE) >> self.pagebits)
+    def load(self, translations):
+        # NOTE: replace every translation, e.g., with those saved in a snapshot
+        self.translations = {}
+        self.frames = {}
+        self.coreids = {}
+        for k, v in translations.items(): self.insert(k, v)
+        _used = set(map(lambda x: (x - self.BASE) >> self.pagebits, self.frames.keys()))
+        self.top = 1 + max(_used, default=-1)
+        self.free = list(filter(lambda x: x not in _used, range(self.top)))
+        heapq.heapify(self.free)
     def get(self, attribute, alternative=None):
         return (self.__dict__[attribute] if attribute in dir(self) else alternative)
     def update(self, d):
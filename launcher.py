@@ -1,126 +1,205 @@
 # Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
 
 import os
+import sys
 import time
 import socket
 import argparse
 import threading
+import selectors
+import heapq
+import gc
+import queue
+import runpy
+import shlex
 import subprocess
+import tempfile
 import logging
 import time
 import json
 
-import elftools.elf.elffile
-
 import service
+import toolbox.elf
 import riscv.constants
 
+class Connections:
+    # Every service's connection, by coreid, along with views of them (each
+    # coreid's connections, all connections) that are rebuilt only when a
+    # service connects or says bye, rather than on every broadcast
+    def __init__(self):
+        self.coreids = {} # NOTE: coreid -> [{'conn': ..., 'name': ...}], most recent first
+        self.views = {}
+        self.all = []
+    def __len__(self): return len(self.all)
+    def __repr__(self): return repr(self.coreids)
+    def update(self):
+        self.views = {k: list(map(lambda x: x.get('conn'), v)) for k, v in self.coreids.items()}
+        self.all = sum(self.views.values(), [])
+    def add(self, coreid, conn, name):
+        self.coreids.update({coreid: [{'conn': conn, 'name': name}] + self.coreids.get(coreid, [])})
+        self.update()
+    def remove(self, coreid, conn):
+        self.coreids.update({coreid: list(filter(lambda x: conn != x.get('conn'), self.coreids.get(coreid, [])))})
+        self.update()
+    def keys(self): return self.views.keys()
+    def get(self, coreid): return self.views.get(coreid, [])
+    def others(self, conn): return filter(lambda x: conn != x, self.all)
+
 def tx(conns, msg):
-    _msg = service.format(msg)
+    _msg = {} # NOTE: encode msg at most once per codec
     for c in conns:
-        service.tx(c, _msg, already_formatted=True)
+        _peer = state.get('peers').get(c)
+        if None == _peer: continue # NOTE: c already said bye
         state.get('service.tx').update({'launcher.py': 1 + state.get('service.tx').get('launcher.py', 0)}) # NOTE: 1 at a time b/c conns might be an iterator
-def handler(conn, addr):
-    global state
-    logging.debug('handler(): {}:{}'.format(*addr))
-    _local = threading.local()
-    _local.name = None
-    _local.instructions_committed = 0
-    _local.buffer = {
-        'info': [],
-        'futures': {},
-    }
-    tx([conn], {'ack': 'launcher'})
-    while True: # FIXME: Break on {'shutdown': ...}, and send {'text': 'bye'} to conn
-        try:
-            msg = service.rx(conn)
-            if _local.name:
-                state.get('lock').acquire()
-                state.get('service.rx').update({_local.name: 1 + state.get('service.rx').get(_local.name, 0)})
-                state.get('lock').release()
-            logging.debug('{}: {}'.format(threading.current_thread().name, msg))
-            k, v = (next(iter(msg.items())) if isinstance(msg, dict) else (None, None))
-            if {k: v} == {'text': 'bye'}:
-                conn.close()
-                state.get('lock').acquire()
-                state.get('connections').update({_local.coreid: list(filter(lambda x: conn != x.get('conn'), state.get('connections').get(_local.coreid)))})
-                state.get('lock').release()
+        if isinstance(c, service.Channel):
+            c.deliver(msg)
+            continue
+        _codec = _peer.get('codec')
+        if _codec not in _msg.keys(): _msg.update({_codec: service.format(msg, _codec)})
+        _peer.get('outbox').extend(_msg.get(_codec))
+        flush(c)
+def flush(conn):
+    # NOTE: send as much of conn's queued outgoing bytes as the socket will
+    #       take without blocking; pump() sends the rest once conn is writable
+    _peer = state.get('peers').get(conn)
+    _outbox = _peer.get('outbox')
+    try:
+        if len(_outbox): del _outbox[:conn.send(_outbox)]
+    except BlockingIOError:
+        pass
+    except OSError:
+        _outbox.clear() # NOTE: conn is gone; pump() will receive its EOF
+    _events = selectors.EVENT_READ | (selectors.EVENT_WRITE if len(_outbox) else 0)
+    if _events != _peer.get('events'):
+        state.get('selector').modify(conn, _events, data=serve)
+        _peer.update({'events': _events})
+def pump(until=lambda : False, timeout=None):
+    # NOTE: the launcher's only event loop: accept connections, receive and
+    #       dispatch messages, and send queued messages until either until()
+    #       holds or timeout (in seconds) elapses
+    _deadline = (time.time() + timeout if None != timeout else None)
+    while not until():
+        _timeout = (_deadline - time.time() if None != _deadline else None)
+        if None != _timeout and 0 >= _timeout: break
+        if state.get('hub'):
+            # NOTE: in-process services' messages all arrive on one queue
+            try:
+                _conn, _msg = state.get('hub').get(timeout=_timeout)
+            except queue.Empty:
                 break
-            elif 'shutdown' == k:
-                state.get('lock').acquire()
-                state.get('shutdown').update({v.get('coreid'): True})
-                state.get('lock').release()
-            elif 'undefined' == k:
-                state.get('lock').acquire()
-                state.update({'undefined': v})
-                state.get('lock').release()
-            elif 'committed' == k:
-                _local.instructions_committed += v
-            elif 'name' == k:
-                threading.current_thread().name = v
-            elif 'coreid' == k:
-                _local.coreid = v
-                _local.name = '[{:04}] {}'.format(_local.coreid, threading.current_thread().name) # NOTE: assumes {'name': ...} arrives before {'coreid': ...}
-                state.get('lock').acquire()
-                state.get('connections').update({_local.coreid: [{'conn': conn, 'name': _local.name}] + state.get('connections').get(_local.coreid, [])})
-                state.get('lock').release()
-            elif 'ack' == k:
-                state.get('lock').acquire()
-                state.get('ack').append({'name': _local.name, 'coreid': _local.coreid, 'msg': msg})
-                logging.debug('{}.handler(): ack: {} ({})'.format(threading.current_thread().name, state.get('ack'), len(state.get('ack'))))
-                state.get('info').extend(_local.buffer.get('info'))
-                _local.buffer.get('info').clear()
-                state.get('futures').update({
-                    c: {
-                        'results': state.get('futures').get(c, {'results': [], 'events': []}).get('results') + _local.buffer.get('futures').get(c).get('results'),
-                        'events': state.get('futures').get(c, {'results': [], 'events': []}).get('events') + _local.buffer.get('futures').get(c).get('events'),
-                    } for c in _local.buffer.get('futures').keys()
-                })
-                _local.buffer.get('futures').clear()
-                state.update({'instructions_committed': _local.instructions_committed + state.get('instructions_committed')})
-                _local.instructions_committed = 0
-                state.get('lock').release()
-            elif 'info' == k:
-                _name = threading.current_thread().name
-                _coreid = _local.coreid
-                _local.buffer.get('info').append('[{:04}] {}.handler(): info : {}'.format(_coreid, _name, v))
-            elif 'result' == k:
-                _arr = v.pop('arrival')
-                assert _arr > state.get('cycle'), '{}.handler(): Attempting to schedule result arrival in the past ({} vs. {})!'.format(threading.current_thread().name, _arr, state.get('cycle'))
-                _res = v
-                _res_evt = _local.buffer.get('futures').get(_arr, {'results': [], 'events': []})
-                _res_evt.get('results').append(_res)
-                _local.buffer.get('futures').update({_arr: _res_evt})
-            elif 'event' == k:
-                _arr = v.pop('arrival')
-                assert _arr > state.get('cycle'), '{}.handler(): Attempting to schedule event arrival in the past ({} vs. {})!'.format(threading.current_thread().name, _arr, state.get('cycle'))
-                _evt = v
-                _res_evt = _local.buffer.get('futures').get(_arr, {'results': [], 'events': []})
-                _res_evt.get('events').append(_evt)
-                _local.buffer.get('futures').update({_arr: _res_evt})
-            elif 'register' == k:
-                _coreid = v.get('coreid')
-                _cmd = v.get('cmd')
-                _name = v.get('name')
-                _data = v.get('data')
-                register(filter(lambda y: conn != y, map(lambda x: x.get('conn'), sum(state.get('connections').values(), []))), _coreid, _cmd, _name, int.from_bytes(_data, 'little'))
-            else:
-                state.get('lock').acquire()
-                state.get('unknown_message_key').append((threading.current_thread().name, msg))
-                state.get('lock').release()
-        except Exception as ex:
-            logging.fatal('{}.handler(): Oopsie! {} (msg : {} ({}:{}), conn : {})'.format(threading.current_thread().name, ex, str(msg), type(msg), len(msg), conn))
-            logging.fatal('{}.handler(): Initiating shutdown...'.format(threading.current_thread().name))
-            state.get('lock').acquire()
-            state.update({'running': False})
-            tx(filter(lambda y: conn != y, map(lambda x: x.get('conn'), sum(state.get('connections').values(), []))), {'text': 'bye'})
-            state.get('lock').release()
-def acceptor():
+            if None == _msg:
+                admit(_conn)
+            elif _conn in state.get('peers').keys():
+                handler(_conn, _msg)
+            continue
+        for key, mask in state.get('selector').select(_timeout): key.data(key.fileobj, mask)
+def accept(s, mask):
+    _conn, _addr = s.accept()
+    logging.debug('accept(): {}'.format(_addr))
+    if socket.AF_INET == _conn.family: _conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    _conn.setblocking(False)
+    admit(_conn)
+    state.get('selector').register(_conn, selectors.EVENT_READ, data=serve)
+def admit(conn):
+    state.get('peers').update({conn: {
+        'name': None,
+        'label': None,
+        'coreid': None,
+        'codec': state.get('codec'), # NOTE: until the service replies with the codec it will use
+        'instructions_committed': 0,
+        'buffer': {
+            'info': [],
+            'futures': {},
+        },
+        'inbox': bytearray(),
+        'outbox': bytearray(),
+        'events': selectors.EVENT_READ,
+    }})
+    tx([conn], {'codec': state.get('codec')})
+def serve(conn, mask):
+    if mask & selectors.EVENT_WRITE: flush(conn)
+    if not mask & selectors.EVENT_READ: return
+    _peer = state.get('peers').get(conn)
+    try:
+        _chunk = conn.recv(service.RECV_SIZE)
+    except BlockingIOError:
+        return
+    except OSError:
+        _chunk = b''
+    if not len(_chunk):
+        handler(conn, {'text': 'bye'}) # NOTE: a closed connection is treated the same as an explicit goodbye
+        return
+    _peer.get('inbox').extend(_chunk)
+    while conn in state.get('peers').keys():
+        msg = service.unframe(_peer.get('inbox'))
+        if isinstance(msg, int): break # NOTE: the rest of the message has not arrived yet
+        handler(conn, msg)
+def handler(conn, msg):
     global state
-    while True:
-        _conn, _addr = state.get('socket').accept()
-        th = threading.Thread(target=handler, args=(_conn, _addr))
-        th.start()
+    _peer = state.get('peers').get(conn)
+    try:
+        if _peer.get('label'): state.get('service.rx').update({_peer.get('label'): 1 + state.get('service.rx').get(_peer.get('label'), 0)})
+        logging.debug('{}: {}'.format(_peer.get('name'), msg))
+        k, v = (next(iter(msg.items())) if isinstance(msg, dict) else (None, None))
+        if {k: v} == {'text': 'bye'}:
+            if not isinstance(conn, service.Channel): state.get('selector').unregister(conn)
+            conn.close()
+            state.get('connections').remove(_peer.get('coreid'), conn)
+            state.get('peers').pop(conn)
+        elif 'codec' == k:
+            _peer.update({'codec': v})
+        elif 'shutdown' == k:
+            state.get('shutdown').update({v.get('coreid'): True})
+        elif 'undefined' == k:
+            state.update({'undefined': v})
+        elif 'committed' == k:
+            _peer.update({'instructions_committed': v + _peer.get('instructions_committed')})
+        elif 'name' == k:
+            _peer.update({'name': v})
+        elif 'coreid' == k:
+            _peer.update({'coreid': v})
+            _peer.update({'label': '[{:04}] {}'.format(_peer.get('coreid'), _peer.get('name'))}) # NOTE: assumes {'name': ...} arrives before {'coreid': ...}
+            state.get('connections').add(_peer.get('coreid'), conn, _peer.get('label'))
+        elif 'ack' == k:
+            state.get('ack').append({'name': _peer.get('label'), 'coreid': _peer.get('coreid'), 'msg': msg})
+            logging.debug('{}.handler(): ack: {} ({})'.format(_peer.get('name'), state.get('ack'), len(state.get('ack'))))
+            state.get('info').extend(_peer.get('buffer').get('info'))
+            _peer.get('buffer').get('info').clear()
+            for c, f in _peer.get('buffer').get('futures').items():
+                for x in f.get('results'): schedule(c, 'results', x)
+                for x in f.get('events'): schedule(c, 'events', x)
+            _peer.get('buffer').get('futures').clear()
+            state.update({'instructions_committed': _peer.get('instructions_committed') + state.get('instructions_committed')})
+            _peer.update({'instructions_committed': 0})
+        elif 'info' == k:
+            _peer.get('buffer').get('info').append('[{:04}] {}.handler(): info : {}'.format(_peer.get('coreid'), _peer.get('name'), v))
+        elif 'result' == k:
+            _arr = v.pop('arrival')
+            assert _arr > state.get('cycle'), '{}.handler(): Attempting to schedule result arrival in the past ({} vs. {})!'.format(_peer.get('name'), _arr, state.get('cycle'))
+            _res = v
+            _res_evt = _peer.get('buffer').get('futures').get(_arr, {'results': [], 'events': []})
+            _res_evt.get('results').append(_res)
+            _peer.get('buffer').get('futures').update({_arr: _res_evt})
+        elif 'event' == k:
+            _arr = v.pop('arrival')
+            assert _arr > state.get('cycle'), '{}.handler(): Attempting to schedule event arrival in the past ({} vs. {})!'.format(_peer.get('name'), _arr, state.get('cycle'))
+            _evt = v
+            _res_evt = _peer.get('buffer').get('futures').get(_arr, {'results': [], 'events': []})
+            _res_evt.get('events').append(_evt)
+            _peer.get('buffer').get('futures').update({_arr: _res_evt})
+        elif 'register' == k:
+            _coreid = v.get('coreid')
+            _cmd = v.get('cmd')
+            _name = v.get('name')
+            _data = v.get('data')
+            register(state.get('connections').others(conn), _coreid, _cmd, _name, int.from_bytes(_data, 'little'))
+        else:
+            state.get('unknown_message_key').append((_peer.get('name'), msg))
+    except Exception as ex:
+        logging.fatal('{}.handler(): Oopsie! {} (msg : {} ({}:{}), conn : {})'.format(_peer.get('name'), ex, str(msg), type(msg), len(msg), conn))
+        logging.fatal('{}.handler(): Initiating shutdown...'.format(_peer.get('name')))
+        state.update({'running': False})
+        tx(state.get('connections').others(conn), {'text': 'bye'})
 def integer(val):
     return {
         '0x': lambda x: int(x, 16),
@@ -159,23 +238,61 @@ def config(connections, service, field, val):
 def restore(state, snapshot_filename):
     logging.info('restore(): snapshot_filename            : {}'.format(snapshot_filename))
     _cycle = 0
-    tx(map(lambda x: x.get('conn'), sum(state.get('connections').values(), [])), {
+    state.update({'ack': []})
+    state.update({'expected': len(state.get('connections'))})
+    tx(state.get('connections').all, {
         'restore': {
             'cycle': _cycle,
             'snapshot_filename': snapshot_filename,
         }
     })
     waitforack(state)
-    return _cycle
+    # NOTE: each service that restored the snapshot reports the cores it
+    #       holds and what remained of the command line when it was taken
+    _restored = list(filter(lambda x: x, map(lambda x: x.get('msg').get('ack').get('restore'), state.get('ack'))))
+    _cores = sorted(set(sum(map(lambda x: x.get('cores'), _restored), [])))
+    _cmdline = next(map(lambda x: x.get('cmdline'), _restored), [])
+    logging.info('restore(): cores                        : {}'.format(_cores))
+    logging.info('restore(): cmdline                      : {}'.format(_cmdline))
+    return _cycle, _cores, _cmdline
+def schedule(cycle, kind, x):
+    # NOTE: each arrival cycle's results and events are kept both in the
+    #       order received (for the services on coreid -1, which get them
+    #       all) and bucketed by coreid; a heap orders the arrival cycles
+    _futures = state.get('futures').get(cycle)
+    if None == _futures:
+        _futures = {'results': [], 'events': [], 'coreid': {}}
+        state.get('futures').update({cycle: _futures})
+        heapq.heappush(state.get('arrivals'), cycle)
+    _futures.get(kind).append(x)
+    _bucket = _futures.get('coreid').get(x.get('coreid'))
+    if None == _bucket:
+        _bucket = {'results': [], 'events': []}
+        _futures.get('coreid').update({x.get('coreid'): _bucket})
+    _bucket.get(kind).append(x)
+def unschedule(coreid):
+    # NOTE: drop every result and event bound for coreid; cycles left empty
+    #       are skipped by nextcycle()
+    for f in filter(lambda x: coreid in x.get('coreid').keys(), state.get('futures').values()):
+        f.get('coreid').pop(coreid)
+        f.update({
+            'results': list(filter(lambda x: coreid != x.get('coreid'), f.get('results'))),
+            'events': list(filter(lambda x: coreid != x.get('coreid'), f.get('events'))),
+        })
+def nextcycle():
+    # returns the earliest cycle at which anything is scheduled, or None
+    _arrivals = state.get('arrivals')
+    while len(_arrivals) and not (len(state.get('futures').get(_arrivals[0]).get('results')) or len(state.get('futures').get(_arrivals[0]).get('events'))):
+        state.get('futures').pop(heapq.heappop(_arrivals))
+    return (_arrivals[0] if len(_arrivals) else None)
+def acked(state):
+    logging.debug('state.ack : {} ({})'.format(state.get('ack'), len(state.get('ack'))))
+    assert len(state.get('ack')) <= state.get('expected'), 'Something ACK\'d more than once!!! state.ack : ({}) {}'.format(len(state.get('ack')), state.get('ack'))
+    return len(state.get('ack')) == state.get('expected')
 def waitforack(state):
-    _ack = False
     logging.debug('state.ack                  : {}'.format(state.get('ack')))
-    logging.debug('state.connections.values() : {}'.format(state.get('connections').values()))
-    while not _ack:
-        time.sleep(0.001)
-        logging.debug('state.ack : {} ({})'.format(state.get('ack'), len(state.get('ack'))))
-        assert len(state.get('ack')) <= len(sum(state.get('connections').values(), [])), 'Something ACK\'d more than once!!! state.ack : ({}) {}'.format(len(state.get('ack')), state.get('ack'))
-        _ack = len(state.get('ack')) == len(sum(state.get('connections').values(), []))
+    logging.debug('state.connections          : {}'.format(state.get('connections')))
+    pump(lambda : acked(state))
 def run(cycle, max_cycles, max_instructions, break_on_undefined, snapshots):
     global state
     # {
@@ -188,30 +305,26 @@ def run(cycle, max_cycles, max_instructions, break_on_undefined, snapshots):
     _cmdline = (list(filter(lambda x: len(x), ' '.join(args.cmdline).strip().split(','))) if args.cmdline else [])
     if snapshots:
         logging.info('snapshots : {}'.format(snapshots))
-        tx(map(lambda x: x.get('conn'), sum(state.get('connections').values(), [])), {
+        tx(state.get('connections').all, {
             'snapshots': {
                 'checkpoints': snapshots,
                 'cmdline': _cmdline,
             }
         })
-    state.get('lock').acquire()
-    for c in (args.config if args.config else []): config(map(lambda x: x.get('conn'), state.get('connections').get(-1)), *c.split(':'))
-    state.get('lock').release()
+    for c in (args.config if args.config else []): config(state.get('connections').get(-1), *c.split(':'))
     if args.restore:
-        _coreid = 0 # snapshot restore for now assumes a single core
-        state.get('shutdown').update({_coreid: False})
-        cycle = restore(state, args.restore)
-        _futures = state.get('futures').pop(1 + cycle, {'results': [], 'events': []})
-        _futures.get('events').extend([{'coreid': _coreid, 'init': True}])
-        state.get('futures').update({1 + cycle: _futures})
-        tx(map(lambda x: x.get('conn'), state.get('connections').get(_coreid)), 'run')
-        tx(map(lambda x: x.get('conn'), state.get('connections').get(-1, [])), 'run')
+        cycle, _cores, _cmdline = restore(state, args.restore)
+        assert all(map(lambda x: x in state.get('connections').keys(), _cores)), 'Snapshot has cores ({}) not in this simulation!'.format(_cores)
+        for _coreid in _cores:
+            state.get('shutdown').update({_coreid: False})
+            schedule(1 + cycle, 'events', {'coreid': _coreid, 'init': True})
+            tx(state.get('connections').get(_coreid), 'run')
+        tx(state.get('connections').get(-1), 'run')
     while (cycle < max_cycles if max_cycles else True) and \
           (state.get('instructions_committed') < max_instructions if max_instructions else True) and \
           (state.get('running')) and \
           (None == state.get('undefined') if break_on_undefined else True):
         logging.info('run(): @{:8}'.format(cycle))
-        state.get('lock').acquire()
         if any(state.get('shutdown').values()) and len(_cmdline):
             _coreid = next(filter(lambda x: state.get('shutdown').get(x), state.get('shutdown').keys()))
             # NOTE: drain results and events from any prior binary executed on this core
@@ -222,15 +335,8 @@ def run(cycle, max_cycles, max_instructions, break_on_undefined, snapshots):
 #                }
 #                for c in state.get('futures').keys()
 #            }})
-            state.update({'futures': {
-                c: {
-                    'results': list(filter(lambda x: coreid != x.get('coreid'), state.get('futures').get(c).get('results'))),
-                    'events': list(filter(lambda x: coreid != x.get('coreid'), state.get('futures').get(c).get('events'))),
-                }
-                for c in state.get('futures').keys()
-                for coreid in filter(lambda x: state.get('shutdown').get(x), state.get('shutdown').keys())
-            }})
-            _conn = list(map(lambda x: x.get('conn'), state.get('connections').get(_coreid)))
+            for coreid in filter(lambda x: state.get('shutdown').get(x), state.get('shutdown').keys()): unschedule(coreid)
+            _conn = state.get('connections').get(_coreid)
             tx(_conn, 'pause')
             for c in (args.config if args.config else []): config(_conn, *c.split(':'))
             _cmd = _cmdline.pop(0).strip().split(' ')
@@ -240,9 +346,9 @@ def run(cycle, max_cycles, max_instructions, break_on_undefined, snapshots):
             _sp = integer(args.loadbin[0])
             _pc = integer(args.loadbin[1])
             _start_symbol = args.loadbin[2]
-            tx(map(lambda x: x.get('conn'), state.get('connections').get(-1, [])), 'pause')
-            tx(map(lambda x: x.get('conn'), state.get('connections').get(-1, [])), {'reset': {'coreid': _coreid}})
-            tx(_conn + list(map(lambda x: x.get('conn'), state.get('connections').get(-1, []))), {
+            tx(state.get('connections').get(-1), 'pause')
+            tx(state.get('connections').get(-1), {'reset': {'coreid': _coreid}})
+            tx(_conn + state.get('connections').get(-1), {
                 'loadbin': {
                     'coreid': _coreid,
                     'start_symbol': _start_symbol,
@@ -250,9 +356,10 @@ def run(cycle, max_cycles, max_instructions, break_on_undefined, snapshots):
                     'pc': _pc,
                     'binary': _binary,
                     'args': ((_binary,) + _args),
+                    **({'cmdline': _cmdline} if snapshots else {}), # NOTE: so snapshots record what remains to be run; only paused services get loadbin, so this draws no ack
                 }
             })
-            tx(map(lambda x: x.get('conn'), state.get('connections').get(-1, [])), 'run')
+            tx(state.get('connections').get(-1), 'run')
             register(_conn, _coreid, 'set', 1, hex(0))
             register(_conn, _coreid, 'set', 2, hex(_sp))
             register(_conn, _coreid, 'set', 4, '0xffff0000') # FIXME: is this necessary???
@@ -267,17 +374,8 @@ def run(cycle, max_cycles, max_instructions, break_on_undefined, snapshots):
             logging.info('\t_args          : {}'.format(_args))
             logging.info('\t_pc            : {}'.format(_pc + get_startsymbol(_binary, _start_symbol)))
             state.get('shutdown').update({_coreid: False})
-            _futures = state.get('futures').pop(1 + cycle, {'results': [], 'events': []})
-            _futures.get('events').extend([{'coreid': _coreid, 'init': True}])
-            state.get('futures').update({1 + cycle: _futures})
+            schedule(1 + cycle, 'events', {'coreid': _coreid, 'init': True})
             tx(_conn, 'run')
-        state.update({'futures': {
-            c: state.get('futures').get(c)
-            for c in filter(
-                lambda x: len(state.get('futures').get(x).get('results')) or len(state.get('futures').get(x).get('events')),
-                state.get('futures').keys()
-            )
-        }})
         if all(state.get('shutdown').values()): state.update({'running': False})
         logging.debug('state.instructions_committed : {}'.format(state.get('instructions_committed')))
         logging.info('\tinfo :\n\t\t{}'.format('\n\t\t'.join(state.get('info'))))
@@ -285,76 +383,133 @@ def run(cycle, max_cycles, max_instructions, break_on_undefined, snapshots):
         logging.info('\tfutures :\n\t\t{}'.format(
             '\t\t'.join(map(lambda a: '{:8}: {}\n'.format(
                 a,
-                state.get('futures').get(a)
-            ), sorted(state.get('futures').keys())))
+                {'results': state.get('futures').get(a).get('results'), 'events': state.get('futures').get(a).get('events')}
+            ), sorted(filter(lambda x: len(state.get('futures').get(x).get('results')) or len(state.get('futures').get(x).get('events')), state.get('futures').keys()))))
         ))
-        cycle = (min(state.get('futures').keys()) if len(state.get('futures').keys()) else 1 + cycle)
-        if 0 == len(state.get('futures').keys()): state.update({'running': False})
-        _futures = state.get('futures').pop(cycle, {'results': [], 'events': []})
+        _next = nextcycle()
+        cycle = (_next if None != _next else 1 + cycle)
+        if None == _next: state.update({'running': False})
+        _futures = (state.get('futures').pop(heapq.heappop(state.get('arrivals'))) if None != _next else {'results': [], 'events': [], 'coreid': {}})
 #        _futures.update({'results': list(filter(lambda x: not state.get('shutdown').get(x.get('coreid')), _futures.get('results')))})
 #        _futures.update({'events': list(filter(lambda x: not state.get('shutdown').get(x.get('coreid')), _futures.get('events')))})
-        state.update({'ack': sum(map(lambda x: [{'coreid': x}] * len(state.get('connections').get(x)), state.get('connections').keys()), [])})
-        logging.debug('state.ack - 0 : {}'.format(state.get('ack')))
+        state.update({'ack': []})
+        state.update({'expected': 0}) # NOTE: only connections sent a tick will ack
 #        for c in state.get('connections').keys():
         for c in filter(lambda x: not state.get('shutdown').get(x), state.get('connections').keys()):
             _res_evt = {
-                'results': (_futures.get('results') if -1 == c else list(filter(lambda x: x.get('coreid') == c, _futures.get('results')))),
-                'events': (_futures.get('events') if -1 == c else list(filter(lambda x: x.get('coreid') == c, _futures.get('events')))),
+                'results': (_futures.get('results') if -1 == c else _futures.get('coreid').get(c, {}).get('results', [])),
+                'events': (_futures.get('events') if -1 == c else _futures.get('coreid').get(c, {}).get('events', [])),
             }
             if 0 == len(sum(_res_evt.values(), [])): continue
-            tx(map(lambda x: x.get('conn'), state.get('connections').get(c)), {'tick': {
+            tx(state.get('connections').get(c), {'tick': {
                 **{'cycle': cycle},
                 **_res_evt,
             }})
-            state.update({'ack': list(filter(lambda x: x.get('coreid') != c, state.get('ack')))})
-            logging.debug('state.ack - 1 : {}'.format(state.get('ack')))
-        state.get('lock').release()
+            state.update({'expected': len(state.get('connections').get(c)) + state.get('expected')})
+            logging.debug('state.expected : {}'.format(state.get('expected')))
         waitforack(state)
     if state.get('undefined'): logging.info('*** Encountered undefined instruction! ***')
     return cycle
+def islocal(host):
+    try:
+        _addr = socket.gethostbyname(host)
+        return _addr.startswith('127.') or _addr == socket.gethostbyname(socket.gethostname())
+    except:
+        return False
+def socketpath(port): return os.path.join(tempfile.gettempdir(), 'nebula.{}.sock'.format(port))
 def add_service(services, arguments, s):
     c, h, p, coreid_init, coreid_fini, params = (s + ('' if 5 == s.count(':') else ':')).split(':')
     params = (params.replace('"', '').strip() if len(params) else None)
     _init = int(coreid_init)
     _fini = (-1 if -1 == _init else int(coreid_fini))
+    # NOTE: services on this machine are exec'd directly; ssh is only
+    #       needed to reach other machines
+    _local = not arguments.inproc and islocal(h)
+    _launcher = (
+        socketpath(arguments.port) if 'unix' == arguments.transport and _local else
+        ('localhost' if _local else socket.gethostbyaddr(socket.gethostname())[0])
+    )
     for coreid in range(_init, 1 + _fini):
-        services.append(
-            threading.Thread(
-                target=subprocess.run,
-                args=([
-                    'ssh',
-                    '-p',
-                    '{}'.format(p),
-                    h,
-                    'python3 {} {} {} {} {} {}'.format(
-                        os.path.join(os.getcwd(), c),
+        if arguments.inproc:
+            services.append(
+                threading.Thread(
+                    target=inproc,
+                    args=(os.path.join(os.getcwd(), c), list(filter(lambda x: len(x), [
                         ('-D' if arguments.debug else ''),
-                        '{}:{}'.format(socket.gethostbyaddr(socket.gethostname())[0], arguments.port),
-                        ('--log {}'.format(arguments.log) if arguments.log else ''),
-                        ('--coreid {}'.format(coreid) if -1 != int(coreid) else ''),
-                        ('{}'.format(params) if params else '')
-                    )
-                ],),
-                daemon=True,
+                        '{}:{}'.format('inproc', arguments.port),
+                        ('--log={}'.format(arguments.log) if arguments.log else ''),
+                        ('--coreid={}'.format(coreid) if -1 != int(coreid) else ''),
+                    ])) + (shlex.split(params) if params else [])),
+                    daemon=True,
+                )
             )
+            if -1 < coreid: state.get('shutdown').update({coreid: True})
+            continue
+        _script = [
+            os.path.join(os.getcwd(), c),
+            ('-D' if arguments.debug else ''),
+            '{}:{}'.format(_launcher, arguments.port),
+            ('--log {}'.format(arguments.log) if arguments.log else ''),
+            ('--coreid {}'.format(coreid) if -1 != int(coreid) else ''),
+            ('{}'.format(params) if params else '')
+        ]
+        _th = threading.Thread(
+            target=subprocess.run,
+            args=(([sys.executable] + shlex.split(' '.join(_script)) if _local else [
+                'ssh',
+                '-p',
+                '{}'.format(p),
+                h,
+                'python3 {}'.format(' '.join(_script)),
+            ]),),
+            daemon=True,
         )
+        _th.remote = not _local
+        services.append(_th)
         if -1 < coreid: state.get('shutdown').update({coreid: True})
 def spawn(services, args):
     if args.services:
         for s in args.services: add_service(services, args, s)
     for th in services:
+        _n = len(state.get('connections'))
         th.start()
-        time.sleep(0.1)
-    while len(services) > len(sum(state.get('connections').values(), [])): time.sleep(1)
-def get_startsymbol(binary, start_symbol):
-    with open(binary, 'rb') as fp:
-        elffile = elftools.elf.elffile.ELFFile(fp)
-        _symbol_tables = [s for s in elffile.iter_sections() if isinstance(s, elftools.elf.elffile.SymbolTableSection)]
-        _start = sum([list(filter(lambda s: start_symbol == s.name, tab.iter_symbols())) for tab in _symbol_tables], [])
-        assert 0 < len(_start), 'No {} symbol!'.format(start_symbol)
-        assert 2 > len(_start), 'More than one {} symbol?!?!?!?'.format(start_symbol)
-        _start = next(iter(_start))
-        return _start.entry.st_value
+        if args.inproc:
+            # NOTE: in-process services share sys.argv, so start each only
+            #       once the one before it has parsed its arguments
+            pump(lambda : _n < len(state.get('connections')) or not th.is_alive())
+            continue
+        # NOTE: local services all start at once; ssh sessions are staggered
+        #       so as not to trip the remote sshd's MaxStartups limit
+        if th.remote: pump(timeout=0.1) # NOTE: accept connections while waiting
+    pump(lambda : len(services) <= len(state.get('connections')))
+class LogRouter(logging.Handler):
+    # In-process services share the launcher's root logger; hand each
+    # thread's records to the log file that thread asked for in its call to
+    # logging.basicConfig(), and everything else to the launcher's own log
+    def __init__(self, default):
+        super().__init__()
+        self.default = default
+        self.routes = {}
+    def basicConfig(self, **kwargs):
+        _handler = logging.FileHandler(kwargs.get('filename'))
+        _handler.setFormatter(logging.Formatter(kwargs.get('format')))
+        _handler.setLevel(kwargs.get('level', logging.WARNING))
+        self.routes.update({threading.get_ident(): _handler})
+    def emit(self, record):
+        _handler = self.routes.get(record.thread, self.default)
+        if record.levelno >= _handler.level: _handler.handle(record)
+def inproc(script, argv):
+    # NOTE: run a service's script as though it were its own process
+    sys.argv = [script] + argv
+    if os.path.dirname(os.path.realpath(script)) not in sys.path: sys.path.insert(0, os.path.dirname(os.path.realpath(script)))
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except Exception as ex:
+        logging.fatal('inproc(): {} failed: {}'.format(script, ex))
+    finally:
+        gc.collect() # NOTE: finalize (e.g., flush and close the files of) what the script left behind, as its exiting would have
+        service.hangup()
+def get_startsymbol(binary, start_symbol): return toolbox.elf.symbol(binary, start_symbol)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Nebula')
@@ -367,6 +522,9 @@ if __name__ == '__main__':
     parser.add_argument('--log', type=str, dest='log', default='/tmp', help='logging output directory')
     parser.add_argument('--max_cycles', type=int, dest='max_cycles', default=None, help='maximum number of cycles to run for')
     parser.add_argument('--max_instructions', type=int, dest='max_instructions', default=None, help='maximum number of instructions to execute')
+    parser.add_argument('--transport', type=str, dest='transport', default='tcp', choices=['tcp', 'unix'], help='how services on this machine connect to the launcher')
+    parser.add_argument('--codec', type=str, dest='codec', default='binary', choices=list(service.CODECS.keys()), help='message encoding used between launcher and services')
+    parser.add_argument('--inproc', dest='inproc', action='store_true', help='run every service in the launcher\'s own process')
     parser.add_argument('--snapshots', type=int, dest='snapshots', nargs='+', help='list of snapshot locations (in instructions)')
     parser.add_argument('port', type=int, help='port for accepting connections')
     parser.add_argument('script', type=str, help='script to be executed by Nebula')
@@ -386,14 +544,20 @@ if __name__ == '__main__':
     assert os.path.exists(args.script), 'Cannot open script file, {}!'.format(args.script)
     logging.debug('args : {}'.format(args))
     state = {
-        'lock': threading.Lock(),
-        'connections': {},
+        'selector': selectors.DefaultSelector(),
+        'peers': {},
+        'connections': Connections(),
         'ack': [],
+        'expected': 0,
         'futures': {},
+        'arrivals': [],
         'info': [],
         'running': False,
         'cycle': 0,
         'socket': None,
+        'unix_socket': None,
+        'hub': None,
+        'codec': args.codec,
         'instructions_committed': 0,
         'shutdown': {},
         'service.tx': {},
@@ -404,11 +568,29 @@ if __name__ == '__main__':
         'config': {
         },
     }
-    state.update({'socket': socket.socket(socket.AF_INET, socket.SOCK_STREAM)})
-    state.get('socket').setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    state.get('socket').bind(('0.0.0.0', args.port))
-    state.get('socket').listen(5)
-    threading.Thread(target=acceptor, daemon=True).start()
+    if args.inproc:
+        # NOTE: services run as threads of this process, and exchange
+        #       messages with the launcher through queues rather than sockets
+        state.update({'hub': queue.SimpleQueue()})
+        service.HUBS.update({args.port: state.get('hub')})
+        logging.getLogger().handlers = [LogRouter(logging.getLogger().handlers[0])]
+        logging.basicConfig = logging.getLogger().handlers[0].basicConfig
+    else:
+        state.update({'socket': socket.socket(socket.AF_INET, socket.SOCK_STREAM)})
+        state.get('socket').setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        state.get('socket').bind(('0.0.0.0', args.port))
+        state.get('socket').listen(socket.SOMAXCONN) # NOTE: every local service may connect at once
+        state.get('socket').setblocking(False)
+        state.get('selector').register(state.get('socket'), selectors.EVENT_READ, data=accept)
+        if 'unix' == args.transport:
+            # NOTE: services on this machine connect through a UNIX domain socket;
+            #       services on other machines still connect through TCP
+            if os.path.exists(socketpath(args.port)): os.unlink(socketpath(args.port))
+            state.update({'unix_socket': socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)})
+            state.get('unix_socket').bind(socketpath(args.port))
+            state.get('unix_socket').listen(socket.SOMAXCONN)
+            state.get('unix_socket').setblocking(False)
+            state.get('selector').register(state.get('unix_socket'), selectors.EVENT_READ, data=accept)
     _services = []
     with open(args.script) as fp:
         for raw in map(lambda x: x.strip(), fp.readlines()):
@@ -420,7 +602,7 @@ if __name__ == '__main__':
                 break
             elif 'tick' == cmd:
                 state.update({'cycle': state.get('cycle') + sum(map(lambda x: integer(x), params))})
-                tx(map(lambda x: x.get('conn'), sum(state.get('connections').values(), [])), {
+                tx(state.get('connections').all, {
                     'tick': {
                         'cycle': state.get('cycle'),
                         'results': [],
@@ -437,12 +619,14 @@ if __name__ == '__main__':
             else:
                 {
                     'service': lambda x: add_service(_services, args, x),
-                    'register': lambda w, x, y, z=None: register(map(lambda x: x.get('conn'), sum(state.get('connections').values(), [])), w, x, y, z),
+                    'register': lambda w, x, y, z=None: register(state.get('connections').all, w, x, y, z),
                     'cycle': lambda: logging.info(state.get('cycle')),
                     'state': lambda: logging.info(state),
-                    'config': lambda x, y: config(map(lambda x: x.get('conn'), sum(state.get('connections').values(), [])), *x.split(':'), y),
+                    'config': lambda x, y: config(state.get('connections').all, *x.split(':'), y),
                     'connections': lambda: logging.info(state.get('connections')),
                 }.get(cmd, lambda : logging.fatal('Unknown command!'))(*params)
-    tx(map(lambda x: x.get('conn'), sum(state.get('connections').values(), [])), 'bye')
+    tx(state.get('connections').all, 'bye')
+    pump(lambda : 0 == len(state.get('peers'))) # NOTE: deliver the goodbyes, and receive the services' in return
     [th.join() for th in _services]
-    logging.info('state : {}'.format(json.dumps({k:v for k, v in state.items() if k not in ['lock', 'socket', 'connections']}, indent=4)))
\ No newline at end of file
+    if state.get('unix_socket'): os.unlink(socketpath(args.port))
+    logging.info('state : {}'.format(json.dumps({k:v for k, v in state.items() if k not in ['selector', 'peers', 'arrivals', 'socket', 'unix_socket', 'hub', 'connections']}, indent=4)))
\ No newline at end of file
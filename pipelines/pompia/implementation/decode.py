@@ -1,15 +1,14 @@
 # Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
 
 import os
-import re
 import sys
 import argparse
 import logging
 import time
-import subprocess
 
 import service
 import toolbox
+import toolbox.elf
 import toolbox.stats
 import components.simplebtb
 import riscv.constants
@@ -78,7 +77,7 @@ def do_issue(service, state):
             **{'iid': state.get('iid')},
             **{'%pc': _pc},
             **{'_pc': int.from_bytes(_pc, 'little')},
-            **({'function': next(filter(lambda x: int.from_bytes(_pc, 'little') >= x[0], sorted(state.get('objmap').items(), reverse=True)))[-1].get('name', '')} if state.get('objmap') else {}),
+            **({'function': toolbox.elf.function(state.get('objmap'), int.from_bytes(_pc, 'little'))} if state.get('objmap') else {}),
         }
         state.update({'iid': 1 + state.get('iid')})
         service.tx({'event': {
@@ -245,22 +244,8 @@ if '__main__' == __name__:
                 )})
                 if not state.get('config').get('toolchain'): continue
                 if not state.get('binary'): continue
-                _toolchain = state.get('config').get('toolchain')
                 _binary = state.get('binary')
-                _files = next(iter(list(os.walk(_toolchain))))[-1]
-                _objdump = next(filter(lambda x: 'objdump' in x, _files))
-                _x = subprocess.run('{} -t {}'.format(os.path.join(_toolchain, _objdump), _binary).split(), capture_output=True)
-                if len(_x.stderr): continue
-                _objdump = _x.stdout.decode('ascii').split('\n')
-                _objdump = sorted(filter(lambda x: len(x), _objdump))
-                _objdump = filter(lambda x: re.search('^0', x), _objdump)
-                _objdump = map(lambda x: x.split(), _objdump)
-                state.update({'objmap': {
-                    int(x[0], 16): {
-                        'flags': x[1:-1],
-                        'name': x[-1]
-                    } for x in _objdump
-                }})
+                state.update({'objmap': toolbox.elf.image(_binary)})
             elif {'text': 'pause'} == {k: v}:
                 state.update({'running': False})
             elif 'binary' == k:
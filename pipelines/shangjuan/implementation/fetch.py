@@ -10,13 +10,17 @@ import service
 import toolbox
 import toolbox.stats
 import components.simplecache
+import components.simplecache.mshr
 import riscv.constants
 
-def fetch_block(service, state, jp):
+def fetch_block(service, state, jp, waiter):
     _blockaddr = state.get('l1ic').blockaddr(jp)
     _blocksize = state.get('l1ic').nbytesperblock
+    _mshr = state.get('mshrs').allocate(_blockaddr, waiter)
+    if 'secondary' == _mshr: state.get('stats').refresh('flat', 'l1ic_mshr_merges')
+    if not _mshr: state.get('stats').refresh('flat', 'l1ic_mshr_stalls')
+    if 'primary' != _mshr: return
     service.tx({'info': 'fetch_block(..., {} ({:08x}))'.format(jp, _blockaddr)})
-    state.get('pending_fetch').append(_blockaddr)
     service.tx({'event': {
         'arrival': 1 + state.get('cycle'),
         'coreid': state.get('coreid'),
@@ -38,8 +42,7 @@ def do_l1ic(service, state):
     _data = state.get('l1ic').peek(_blockaddr, _blocksize)
     service.tx({'info': '_data : {}'.format(_data)})
     if not _data:
-        if len(state.get('pending_fetch')): return # only 1 pending fetch at a time is primitive, but good enough for now
-        fetch_block(service, state, _jp)
+        fetch_block(service, state, _jp, _jp)
         return
     _data = _data[(_jp - _blockaddr):]
     service.tx({'result': {
@@ -65,10 +68,11 @@ def do_l1ic(service, state):
 def do_tick(service, state, results, events):
     for _l2 in map(lambda y: y.get('l2'), filter(lambda x: x.get('l2'), results)):
         _addr = _l2.get('addr')
-        if _addr not in state.get('pending_fetch'): continue
+        if _addr not in state.get('mshrs'): continue
+        if not 'data' in _l2.keys(): continue # b/c lower levels in the cache hierarchy report POKE oeprations
         service.tx({'info': '_l2 : {}'.format(_l2)})
         state.get('l1ic').poke(_addr, _l2.get('data'))
-        state.get('pending_fetch').remove(_addr)
+        state.get('mshrs').retire(_addr)
     for _perf in map(lambda y: y.get('perf'), filter(lambda x: x.get('perf'), events)):
         _cmd = _perf.get('cmd')
         if 'report_stats' == _cmd:
@@ -78,11 +82,12 @@ def do_tick(service, state, results, events):
         if 'cmd' in _fetch.keys():
             if 'purge' == _fetch.get('cmd'):
                 state.get('l1ic').purge()
-                state.get('pending_fetch').clear()
+                state.get('mshrs').clear()
             elif 'get' == _fetch.get('cmd'):
                 state.get('fetch_buffer').append({
                     'addr': _fetch.get('addr'),
                 })
+    state.get('stats').refresh('histo', 'l1ic_mshr_occupancy', len(state.get('mshrs')))
     if not len(state.get('fetch_buffer')): return
     service.tx({'info': 'fetch_buffer : {}'.format(state.get('fetch_buffer'))})
     do_l1ic(service, state)
@@ -115,7 +120,7 @@ if '__main__' == __name__:
         'cycle': 0,
         'coreid': args.coreid,
         'l1ic': None,
-        'pending_fetch': [],
+        'mshrs': None,
         'active': True,
         'running': False,
         'fetch_buffer': [],
@@ -128,6 +133,7 @@ if '__main__' == __name__:
             'l1ic_nways': 2**1,
             'l1ic_nbytesperblock': 2**4,
             'l1ic_evictionpolicy': 'lru',
+            'l1ic_mshr_entries': 2**2,
         },
     }
     _service = service.Service(state.get('service'), state.get('coreid'), _launcher.get('host'), _launcher.get('port'))
@@ -144,7 +150,7 @@ if '__main__' == __name__:
                 logging.info('state.config : {}'.format(state.get('config')))
                 state.update({'running': True})
                 state.update({'ack': False})
-                state.update({'pending_fetch': []})
+                state.update({'mshrs': components.simplecache.mshr.MSHRFile(state.get('config').get('l1ic_mshr_entries'))})
                 state.update({'active': True})
                 state.update({'fetch_buffer': []})
                 state.update({'%jp': None})
@@ -10,14 +10,18 @@ import service
 import toolbox
 import toolbox.stats
 import components.simplecache
+import components.simplecache.mshr
 import components.simplemmu
 import riscv.constants
 
-def fetch_block(service, state, jp, physical):
+def fetch_block(service, state, jp, physical, waiter):
     _blockaddr = state.get('l1ic').blockaddr(jp)
     _blocksize = state.get('l1ic').nbytesperblock
+    _mshr = state.get('mshrs').allocate(_blockaddr, waiter)
+    if 'secondary' == _mshr: state.get('stats').refresh('flat', 'l1ic_mshr_merges')
+    if not _mshr: state.get('stats').refresh('flat', 'l1ic_mshr_stalls')
+    if 'primary' != _mshr: return
     service.tx({'info': 'fetch_block(..., {} ({:08x}))'.format(jp, _blockaddr)})
-    state.get('pending_fetch').append(_blockaddr)
     service.tx({'event': {
         'arrival': 1 + state.get('cycle'),
         'coreid': state.get('coreid'),
@@ -45,8 +49,7 @@ def do_l1ic(service, state):
     _data = state.get('l1ic').peek(_blockaddr, _blocksize)
     service.tx({'info': '_data : {}'.format(_data)})
     if not _data:
-        if len(state.get('pending_fetch')): return # only 1 pending fetch at a time is primitive, but good enough for now
-        fetch_block(service, state, _jp, _physical)
+        fetch_block(service, state, _jp, _physical, _vaddr)
         return
     _data = _data[(_jp - _blockaddr):]
     service.tx({'result': {
@@ -74,15 +77,15 @@ def do_tick(service, state, results, events):
     for _mispr in map(lambda y: y.get('mispredict'), filter(lambda x: x.get('mispredict'), results)):
         service.tx({'info': '_mispr : {}'.format(_mispr)})
         logging.info('_mispr : {}'.format(_mispr))
-        state.get('pending_fetch').clear()
         state.get('fetch_buffer').clear()
         state.update({'mispredict': _mispr})
     for _l2 in map(lambda y: y.get('l2'), filter(lambda x: x.get('l2'), results)):
         _addr = _l2.get('addr')
-        if _addr not in state.get('pending_fetch'): continue
+        if _addr not in state.get('mshrs'): continue
+        if not 'data' in _l2.keys(): continue # b/c lower levels in the cache hierarchy report POKE oeprations
         service.tx({'info': '_l2 : {}'.format(_l2)})
         state.get('l1ic').poke(_addr, _l2.get('data'))
-        state.get('pending_fetch').remove(_addr)
+        state.get('mshrs').retire(_addr)
     for _mmu in map(lambda y: y.get('mmu'), filter(lambda x: x.get('mmu'), results)):
         _vaddr = _mmu.get('vaddr')
         _pagesize = state.get('config').get('pagesize')
@@ -99,7 +102,7 @@ def do_tick(service, state, results, events):
         if 'cmd' in _fetch.keys():
             if 'purge' == _fetch.get('cmd'):
                 state.get('l1ic').purge()
-                state.get('pending_fetch').clear()
+                state.get('mshrs').clear()
             elif 'get' == _fetch.get('cmd'):
                 if state.get('mispredict'): continue
                 _vaddr = _fetch.get('addr')
@@ -119,6 +122,7 @@ def do_tick(service, state, results, events):
                         }
                     }})
     service.tx({'info': 'state.fetch_buffer : {}'.format(state.get('fetch_buffer'))})
+    state.get('stats').refresh('histo', 'l1ic_mshr_occupancy', len(state.get('mshrs')))
     if not len(state.get('fetch_buffer')): return
     do_l1ic(service, state)
     
@@ -152,7 +156,7 @@ if '__main__' == __name__:
         'l1ic': None,
         'tlb': {},
         'pending_v2p': [],
-        'pending_fetch': [],
+        'mshrs': None,
         'active': True,
         'running': False,
         'fetch_buffer': [],
@@ -166,6 +170,7 @@ if '__main__' == __name__:
             'l1ic_nways': 2**1,
             'l1ic_nbytesperblock': 2**4,
             'l1ic_evictionpolicy': 'lru',
+            'l1ic_mshr_entries': 2**2,
             'pagesize': 2**16,
         },
     }
@@ -185,7 +190,7 @@ if '__main__' == __name__:
                 state.update({'ack': False})
                 state.update({'tlb': {}})
                 state.update({'pending_v2p': []})
-                state.update({'pending_fetch': []})
+                state.update({'mshrs': components.simplecache.mshr.MSHRFile(state.get('config').get('l1ic_mshr_entries'))})
                 state.update({'mispredict': None})
                 state.update({'active': True})
                 state.update({'fetch_buffer': []})
@@ -12,16 +12,20 @@ import service
 import toolbox
 import toolbox.stats
 import components.simplecache
+import components.simplecache.mshr
 import components.simplemmu
 import riscv.execute
 import riscv.constants
 import riscv.syscall.linux
 
-def fetch_block(service, state, addr, physical):
+def fetch_block(service, state, addr, physical, waiter):
     _blockaddr = state.get('l1dc').blockaddr(addr)
     _blocksize = state.get('l1dc').nbytesperblock
+    _mshr = state.get('mshrs').allocate(_blockaddr, waiter)
+    if 'secondary' == _mshr: state.get('stats').refresh('flat', 'l1dc_mshr_merges')
+    if not _mshr: state.get('stats').refresh('flat', 'l1dc_mshr_stalls')
+    if 'primary' != _mshr: return
     service.tx({'info': 'fetch_block(..., {} ({:08x}))'.format(addr, _blockaddr)})
-    state.get('pending_fetch').append(_blockaddr)
     service.tx({'event': {
         'arrival': 1 + state.get('cycle'),
         'coreid': state.get('coreid'),
@@ -35,6 +39,7 @@ def fetch_block(service, state, addr, physical):
 #    toolbox.report_stats(service, state, 'flat', 'l1dc_misses')
     state.get('stats').refresh('flat', 'l1dc_misses')
 def do_l1dc(service, state):
+    state.get('stats').refresh('histo', 'l1dc_mshr_occupancy', len(state.get('mshrs')))
     for _insn in filter(lambda x: not x.get('done'), state.get('executing')):
         _vaddr = _insn.get('operands').get('addr')
         _pagesize = state.get('config').get('pagesize')
@@ -49,8 +54,7 @@ def do_l1dc(service, state):
         if state.get('l1dc').fits(_addr, _size):
             _data = state.get('l1dc').peek(_addr, _size)
             if not _data:
-                if len(state.get('pending_fetch')): continue # only 1 pending fetch at a time is primitive, but good enough for now
-                fetch_block(service, state, _addr, _physical)
+                fetch_block(service, state, _addr, _physical, _insn.get('iid'))
                 continue
             service.tx({'info': '_data : @{} {}'.format(_addr, _data)})
         else:
@@ -59,13 +63,11 @@ def do_l1dc(service, state):
             _antesize = _blockaddr + _blocksize - _addr
             _ante = state.get('l1dc').peek(_addr, _antesize)
             if not _ante:
-                if len(state.get('pending_fetch')): continue # only 1 pending fetch at a time is primitive, but good enough for now
-                fetch_block(service, state, _addr, _physical)
+                fetch_block(service, state, _addr, _physical, _insn.get('iid'))
                 continue
             _post = state.get('l1dc').peek(_addr + len(_ante), _size - len(_ante))
             if not _post:
-                if len(state.get('pending_fetch')): continue # only 1 pending fetch at a time is primitive, but good enough for now
-                fetch_block(service, state, _addr + len(_ante), _physical)
+                fetch_block(service, state, _addr + len(_ante), _physical, _insn.get('iid'))
                 continue
             service.tx({'info': '_ante : @{} {}'.format(_addr, _ante)})
             service.tx({'info': '_post : @{} {}'.format(_addr + len(_ante), _post)})
@@ -111,7 +113,6 @@ def do_l1dc(service, state):
                 },
             }})
         _insn.update({'done': True})
-        if len(state.get('pending_fetch')): state.get('pending_fetch').pop(0)
 #        toolbox.report_stats(service, state, 'flat', 'l1dc_accesses')
         state.get('stats').refresh('flat', 'l1dc_accesses')
 
@@ -189,11 +190,11 @@ def do_tick(service, state, results, events):
             state.get('pending_execute')[_ndx].update({'retired': True})
     for _l2 in filter(lambda x: x, map(lambda y: y.get('l2'), results)):
         _addr = _l2.get('addr')
-        if _addr not in state.get('pending_fetch'): continue
+        if _addr not in state.get('mshrs'): continue
         if not 'data' in _l2.keys(): continue # b/c lower levels in the cache hierarchy report POKE oeprations
         service.tx({'info': '_l2 : {}'.format(_l2)})
         state.get('l1dc').poke(_addr, _l2.get('data'))
-        state.get('pending_fetch').remove(_addr)
+        state.get('mshrs').retire(_addr)
     for _mmu in map(lambda y: y.get('mmu'), filter(lambda x: x.get('mmu'), results)):
         _vaddr = _mmu.get('vaddr')
         _pagesize = state.get('config').get('pagesize')
@@ -286,7 +287,7 @@ if '__main__' == __name__:
         'l1dc': None,
         'tlb': {},
         'pending_v2p': [],
-        'pending_fetch': [],
+        'mshrs': None,
         'active': True,
         'running': False,
         'ack': True,
@@ -298,6 +299,7 @@ if '__main__' == __name__:
             'l1dc_nways': 2**1,
             'l1dc_nbytesperblock': 2**4,
             'l1dc_evictionpolicy': 'lru',
+            'l1dc_mshr_entries': 2**2,
             'pagesize': 2**16,
         },
     }
@@ -317,7 +319,7 @@ if '__main__' == __name__:
                 state.update({'ack': False})
                 state.update({'tlb': {}})
                 state.update({'pending_v2p': []})
-                state.update({'pending_fetch': []})
+                state.update({'mshrs': components.simplecache.mshr.MSHRFile(state.get('config').get('l1dc_mshr_entries'))})
                 state.update({'pending_execute': []})
                 state.update({'executing': []})
                 _service.tx({'info': 'state.config : {}'.format(state.get('config'))})
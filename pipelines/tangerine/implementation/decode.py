@@ -1,16 +1,15 @@
 # Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
 
 import os
-import re
 import sys
 import argparse
 import logging
 import time
 import itertools
-import subprocess
 
 import service
 import toolbox
+import toolbox.elf
 import toolbox.stats
 import riscv.constants
 import riscv.decode
@@ -51,22 +50,8 @@ class Decode:
         self.update({'buffer': []})
         if not self.get('config').get('toolchain'): return
         if not self.get('binary'): return
-        _toolchain = self.get('config').get('toolchain')
         _binary = self.get('binary')
-        _files = next(iter(list(os.walk(_toolchain))))[-1]
-        _objdump = next(filter(lambda x: 'objdump' in x, _files))
-        _x = subprocess.run('{} -t {}'.format(os.path.join(_toolchain, _objdump), _binary).split(), capture_output=True)
-        if len(_x.stderr): return
-        _objdump = _x.stdout.decode('ascii').split('\n')
-        _objdump = sorted(filter(lambda x: len(x), _objdump))
-        _objdump = filter(lambda x: re.search('^0', x), _objdump)
-        _objdump = map(lambda x: x.split(), _objdump)
-        self.update({'objmap': {
-            int(x[0], 16): {
-                'flags': x[1:-1],
-                'name': x[-1]
-            } for x in _objdump
-        }})
+        self.update({'objmap': toolbox.elf.image(_binary)})
     def do_tick(self, results, events, **kwargs):
         self.update({'cycle': kwargs.get('cycle', self.cycle)})
         logging.debug('Decode.do_tick(): results : {}'.format(results))
@@ -103,7 +88,7 @@ class Decode:
                 **_insn,
                 **{'%pc': self.get('%pc')},
                 **{'_pc': _pc},
-                **({'function': next(filter(lambda x: _pc >= x[0], sorted(self.get('objmap').items(), reverse=True)))[-1].get('name', '')} if self.get('objmap') else {}),
+                **({'function': toolbox.elf.function(self.get('objmap'), _pc)} if self.get('objmap') else {}),
             })
             logging.debug('Decode.do_tick(): {:8x} : {}'.format(_pc, _decoded[-1]))
             self.get('stats').refresh('histo', 'decoded_insn', _insn.get('cmd'))
@@ -10,6 +10,7 @@ import service
 import toolbox
 import toolbox.stats
 import components.simplecache
+import components.simplecache.mshr
 import components.simplemmu
 import riscv.constants
 
@@ -26,7 +27,7 @@ class Fetch:
         self.stats = toolbox.stats.CounterBank(coreid, name)
         self.l1ic = None
         self.pending_v2p = []
-        self.pending_fetch = []
+        self.mshrs = None
         self.fetch_buffer = []
         self.mispredict = None
         self.config = {
@@ -34,6 +35,7 @@ class Fetch:
             'l1ic_nways': 2**1,
             'l1ic_nbytesperblock': 2**4,
             'l1ic_evictionpolicy': 'lru',
+            'l1ic_mshr_entries': 2**2,
             'pagesize': 2**16,
         }
     def state(self):
@@ -49,7 +51,7 @@ class Fetch:
     def boot(self):
         self.update({'tlb': {}})
         self.update({'pending_v2p': []})
-        self.update({'pending_fetch': []})
+        self.update({'mshrs': components.simplecache.mshr.MSHRFile(self.get('config').get('l1ic_mshr_entries'))})
         self.update({'mispredict': None})
         self.update({'fetch_buffer': []})
         self.update({'l1ic': components.simplecache.SimpleCache(
@@ -58,11 +60,14 @@ class Fetch:
                     self.get('config').get('l1ic_nbytesperblock'),
                     self.get('config').get('l1ic_evictionpolicy'),
                 )})
-    def fetch_block(self, jp, physical):
+    def fetch_block(self, jp, physical, waiter):
         _blockaddr = self.get('l1ic').blockaddr(jp)
         _blocksize = self.get('l1ic').nbytesperblock
+        _mshr = self.get('mshrs').allocate(_blockaddr, waiter)
+        if 'secondary' == _mshr: self.get('stats').refresh('flat', 'l1ic_mshr_merges')
+        if not _mshr: self.get('stats').refresh('flat', 'l1ic_mshr_stalls')
+        if 'primary' != _mshr: return
         logging.info(os.path.basename(__file__) + ': fetch_block(..., {} ({:08x}))'.format(jp, _blockaddr))
-        self.get('pending_fetch').append(_blockaddr)
         self.service.tx({'event': {
             'arrival': 1 + self.get('cycle'),
             'coreid': self.get('coreid'),
@@ -89,8 +94,7 @@ class Fetch:
         _data = self.get('l1ic').peek(_blockaddr, _blocksize)
         logging.info(os.path.basename(__file__) + ': _data : {}'.format(_data))
         if not _data:
-            if len(self.get('pending_fetch')): return # only 1 pending fetch at a time is primitive, but good enough for now
-            self.fetch_block(_jp, _physical)
+            self.fetch_block(_jp, _physical, _vaddr)
             return
         _data = _data[(_jp - _blockaddr):]
         self.service.tx({'result': {
@@ -115,15 +119,15 @@ class Fetch:
     def do_results(self, results):
         for _mispr in map(lambda y: y.get('mispredict'), filter(lambda x: x.get('mispredict'), results)):
             logging.info(os.path.basename(__file__) + ': _mispr : {}'.format(_mispr))
-            self.get('pending_fetch').clear()
             self.get('fetch_buffer').clear()
             self.update({'mispredict': _mispr})
         for _l2 in map(lambda y: y.get('l2'), filter(lambda x: x.get('l2'), results)):
             _addr = _l2.get('addr')
-            if _addr not in self.get('pending_fetch'): continue
+            if _addr not in self.get('mshrs'): continue
+            if not 'data' in _l2.keys(): continue # b/c lower levels in the cache hierarchy report POKE oeprations
             logging.info(os.path.basename(__file__) + ': _l2 : {}'.format(_l2))
             self.get('l1ic').poke(_addr, _l2.get('data'))
-            self.get('pending_fetch').remove(_addr)
+            self.get('mshrs').retire(_addr)
         for _mmu in map(lambda y: y.get('mmu'), filter(lambda x: x.get('mmu'), results)):
             _vaddr = _mmu.get('vaddr')
             _pagesize = self.get('config').get('pagesize')
@@ -141,7 +145,7 @@ class Fetch:
             if 'cmd' in _fetch.keys():
                 if 'purge' == _fetch.get('cmd'):
                     self.get('l1ic').purge()
-                    self.get('pending_fetch').clear()
+                    self.get('mshrs').clear()
                 elif 'get' == _fetch.get('cmd'):
                     if self.get('mispredict'): continue
                     _vaddr = _fetch.get('addr')
@@ -166,5 +170,6 @@ class Fetch:
         self.do_results(results)
         self.do_events(events)
         logging.info(os.path.basename(__file__) + ': state.fetch_buffer : {}'.format(self.get('fetch_buffer')))
+        self.get('stats').refresh('histo', 'l1ic_mshr_occupancy', len(self.get('mshrs')))
         if not len(self.get('fetch_buffer')): return
         self.do_l1ic()
@@ -12,6 +12,7 @@ import service
 import toolbox
 import toolbox.stats
 import components.simplecache
+import components.simplecache.mshr
 import components.simplemmu
 import riscv.execute
 import riscv.constants
@@ -28,11 +29,14 @@ def do_load(service, state, insn):
 def do_store(service, state, insn):
     insn.update({'result': None})
 
-def fetch_block(service, state, addr, physical):
+def fetch_block(service, state, addr, physical, waiter):
     _blockaddr = state.get('l1dc').blockaddr(addr)
     _blocksize = state.get('l1dc').nbytesperblock
+    _mshr = state.get('mshrs').allocate(_blockaddr, waiter)
+    if 'secondary' == _mshr: state.get('stats').refresh('flat', 'l1dc_mshr_merges')
+    if not _mshr: state.get('stats').refresh('flat', 'l1dc_mshr_stalls')
+    if 'primary' != _mshr: return
     logging.info(os.path.basename(__file__) + ': fetch_block(..., {} ({:08x}))'.format(addr, _blockaddr))
-    state.get('pending_fetch').append(_blockaddr)
     service.tx({'event': {
         'arrival': 1 + state.get('cycle'),
         'coreid': state.get('coreid'),
@@ -45,6 +49,7 @@ def fetch_block(service, state, addr, physical):
     }})
     state.get('stats').refresh('flat', 'l1dc_misses')
 def do_l1dc(service, state):
+    state.get('stats').refresh('histo', 'l1dc_mshr_occupancy', len(state.get('mshrs')))
     for _insn in filter(lambda x: not x.get('done'), state.get('executing')):
         _vaddr = _insn.get('operands').get('addr')
         _pagesize = state.get('config').get('pagesize')
@@ -59,8 +64,7 @@ def do_l1dc(service, state):
         if state.get('l1dc').fits(_addr, _size):
             _data = state.get('l1dc').peek(_addr, _size)
             if not _data:
-                if len(state.get('pending_fetch')): continue # only 1 pending fetch at a time is primitive, but good enough for now
-                fetch_block(service, state, _addr, _physical)
+                fetch_block(service, state, _addr, _physical, _insn.get('iid'))
                 continue
             logging.info(os.path.basename(__file__) + ': _data : @{} {}'.format(_addr, _data))
         else:
@@ -69,13 +73,11 @@ def do_l1dc(service, state):
             _antesize = _blockaddr + _blocksize - _addr
             _ante = state.get('l1dc').peek(_addr, _antesize)
             if not _ante:
-                if len(state.get('pending_fetch')): continue # only 1 pending fetch at a time is primitive, but good enough for now
-                fetch_block(service, state, _addr, _physical)
+                fetch_block(service, state, _addr, _physical, _insn.get('iid'))
                 continue
             _post = state.get('l1dc').peek(_addr + len(_ante), _size - len(_ante))
             if not _post:
-                if len(state.get('pending_fetch')): continue # only 1 pending fetch at a time is primitive, but good enough for now
-                fetch_block(service, state, _addr + len(_ante), _physical)
+                fetch_block(service, state, _addr + len(_ante), _physical, _insn.get('iid'))
                 continue
             logging.info(os.path.basename(__file__) + ': _ante : @{} {}'.format(_addr, _ante))
             logging.info(os.path.basename(__file__) + ': _post : @{} {}'.format(_addr + len(_ante), _post))
@@ -121,7 +123,6 @@ def do_l1dc(service, state):
                 },
             }})
         _insn.update({'done': True})
-        if len(state.get('pending_fetch')): state.get('pending_fetch').pop(0)
         state.get('stats').refresh('flat', 'l1dc_accesses')
 def do_execute(service, state):
     for _insn in state.get('pending_execute'):
@@ -186,6 +187,7 @@ class LSU:
             'l1dc_nways': 2**1,
             'l1dc_nbytesperblock': 2**4,
             'l1dc_evictionpolicy': 'lru',
+            'l1dc_mshr_entries': 2**2,
             'pagesize': 2**16,
         }
     def state(self):
@@ -201,7 +203,7 @@ class LSU:
     def boot(self):
         self.update({'tlb': {}})
         self.update({'pending_v2p': []})
-        self.update({'pending_fetch': []})
+        self.update({'mshrs': components.simplecache.mshr.MSHRFile(self.get('config').get('l1dc_mshr_entries'))})
         self.update({'pending_execute': []})
         self.update({'executing': []})
         self.update({'l1dc': components.simplecache.SimpleCache(
@@ -225,11 +227,11 @@ class LSU:
                 self.get('pending_execute')[_ndx].update({'retired': True})
         for _l2 in filter(lambda x: x, map(lambda y: y.get('l2'), results)):
             _addr = _l2.get('addr')
-            if _addr not in self.get('pending_fetch'): continue
+            if _addr not in self.get('mshrs'): continue
             if not 'data' in _l2.keys(): continue # b/c lower levels in the cache hierarchy report POKE oeprations
             logging.info(os.path.basename(__file__) + ': _l2 : {}'.format(_l2))
             self.get('l1dc').poke(_addr, _l2.get('data'))
-            self.get('pending_fetch').remove(_addr)
+            self.get('mshrs').retire(_addr)
         for _mmu in map(lambda y: y.get('mmu'), filter(lambda x: x.get('mmu'), results)):
             _vaddr = _mmu.get('vaddr')
             _pagesize = self.get('config').get('pagesize')
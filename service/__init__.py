@@ -1,43 +1,243 @@
 # Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
 
+import os
 import socket
 import json
-import time
 import zlib
+import struct
+import weakref
+import queue
+import threading
 
 class Service:
-    MESSAGE_SIZE = 2**16
+    HEADER_SIZE = 8 # NOTE: every message is preceded by its length, in bytes, as a little-endian integer
     def __init__(self, name, coreid, host=None, port=None, **kwargs):
         self.name = name
         self.coreid = coreid
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.s.connect((host, port))
+        self.codec = 'json' # NOTE: until the launcher says otherwise
+        self.s = connect(host, port)
         self.tx({'name': self.name})
         self.tx({'coreid': self.coreid})
+        self.negotiate(kwargs.get('codec'))
     def __del__(self):
         self.s.close()
-    def rx(self): return rx(self.s)
-    def tx(self, msg): tx(self.s, format(msg), already_formatted=True)
-def format(msg):
-    # HACK: This pads all messages to be exactly self.MESSAGE_SIZE bytes.
-    # HACK: It's dumb, but I want to focus on something else right now.
-    _message = zlib.compress({
-        str: lambda : json.dumps({'text': msg}),
-        dict: lambda : json.dumps(msg),
-    }.get(type(msg), lambda : json.dumps({'error': 'Undeliverable object'}))().encode('ascii'), level=zlib.Z_BEST_SPEED)
-    assert Service.MESSAGE_SIZE >= len(_message), 'Message ({} B) too big!'.format(len(_message))
-    _message += (' ' * (Service.MESSAGE_SIZE - len(_message))).encode('ascii')
-    return _message
+    def negotiate(self, codec=None):
+        # NOTE: the launcher's first message on every connection names the
+        # codec it prefers; adopt it (unless told otherwise), and tell the
+        # launcher which codec this service will use from now on
+        _hello = self.rx()
+        _codec = (codec if codec else _hello.get('codec'))
+        self.codec = (_codec if _codec in CODECS.keys() else 'json')
+        self.tx({'codec': self.codec})
+    def rx(self): return (self.s.rx() if isinstance(self.s, Channel) else rx(self.s))
+    def tx(self, msg):
+        if isinstance(self.s, Channel): return self.s.tx(msg)
+        tx(self.s, format(msg, self.codec), already_formatted=True)
+
+class Channel:
+    # A service's connection to a launcher running in the same process; the
+    # launcher reads every service's messages from one queue (its hub), and
+    # each service reads its own messages from its channel's inbox
+    def __init__(self, hub):
+        self.hub = hub
+        self.inbox = queue.SimpleQueue()
+        self.closed = False
+        _LOCAL.__dict__.setdefault('channels', []).append(self)
+        self.hub.put((self, None)) # NOTE: the in-process equivalent of accept()
+    def rx(self): return self.inbox.get()
+    def tx(self, msg): self.hub.put((self, normalize(envelope(msg))))
+    def deliver(self, msg): self.inbox.put(normalize(envelope(msg)))
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        self.hub.put((self, {'text': 'bye'}))
+HUBS = {} # NOTE: port -> queue of (Channel, msg) read by an in-process launcher
+_LOCAL = threading.local()
+def hangup():
+    # NOTE: close every channel opened by the calling thread, i.e., what
+    #       the OS does to a service process's sockets when it exits
+    for c in _LOCAL.__dict__.pop('channels', []): c.close()
+
+def connect(host, port):
+    if 'inproc' == host: return Channel(HUBS.get(port))
+    # NOTE: a launcher on the same machine may be reached through a UNIX
+    #       domain socket, in which case host is the socket's path
+    if host.startswith(os.sep):
+        _s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        _s.connect(host)
+    else:
+        _s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        _s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # NOTE: messages are small, so do not wait to coalesce them
+        _s.connect((host, port))
+    return _s
+
+_U32 = struct.Struct('<I')
+_I64 = struct.Struct('<q')
+_F64 = struct.Struct('<d')
+_STRINGS = {}
+def _string(s):
+    # NOTE: dict keys and short strings (e.g., 'coreid', 'results', 'cmd')
+    #       recur in nearly every message, so their encodings are cached
+    _retval = _STRINGS.get(s)
+    if None == _retval:
+        _s = s.encode('utf-8')
+        _retval = (bytes((0x07, len(_s))) if 2**8 > len(_s) else b'\x08' + _U32.pack(len(_s))) + _s
+        if 2**6 > len(_s) and 2**12 > len(_STRINGS): _STRINGS.update({s: _retval})
+    return _retval
+def _key(k):
+    # NOTE: mimic JSON, which only has string keys
+    if isinstance(k, str): return k
+    return (json.dumps(k) if None == k or isinstance(k, bool) else str(k))
+def encode_binary(msg, buf):
+    # Tagged binary encoding; every value is preceded by a 1-byte tag:
+    #   0x00 None, 0x01 False, 0x02 True,
+    #   0x03 int in [0, 256) (1 byte), 0x04 int64, 0x05 arbitrary-size int,
+    #   0x06 float64,
+    #   0x07/0x08 str (1-/4-byte length),
+    #   0x09/0x0e list of ints in [0, 256) packed 1 byte apiece (1-/4-byte length),
+    #   0x0a/0x0b list (1-/4-byte count), 0x0c/0x0d dict (1-/4-byte count)
+    # Decoding yields exactly what a JSON round trip would: tuples become
+    # lists and dict keys become strings.
+    _t = type(msg)
+    if str == _t:
+        buf += _string(msg)
+    elif int == _t:
+        if 0 <= msg < 2**8:
+            buf += bytes((0x03, msg))
+        elif -2**63 <= msg < 2**63:
+            buf += b'\x04'
+            buf += _I64.pack(msg)
+        else:
+            _b = msg.to_bytes(1 + msg.bit_length() // 8, 'little', signed=True)
+            buf += b'\x05'
+            buf += _U32.pack(len(_b))
+            buf += _b
+    elif dict == _t:
+        buf += (bytes((0x0c, len(msg))) if 2**8 > len(msg) else b'\x0d' + _U32.pack(len(msg)))
+        for k, v in msg.items():
+            buf += _string(_key(k))
+            encode_binary(v, buf)
+    elif list == _t or tuple == _t:
+        if len(msg) and {int} == set(map(type, msg)):
+            try:
+                _b = bytes(msg)
+                buf += (bytes((0x09, len(_b))) if 2**8 > len(_b) else b'\x0e' + _U32.pack(len(_b)))
+                buf += _b
+                return buf
+            except ValueError:
+                pass # NOTE: at least one int is outside [0, 256)
+        buf += (bytes((0x0a, len(msg))) if 2**8 > len(msg) else b'\x0b' + _U32.pack(len(msg)))
+        for v in msg: encode_binary(v, buf)
+    elif None == msg:
+        buf += b'\x00'
+    elif True is msg:
+        buf += b'\x02'
+    elif False is msg:
+        buf += b'\x01'
+    elif float == _t:
+        buf += b'\x06'
+        buf += _F64.pack(msg)
+    else:
+        raise TypeError('Cannot encode {} ({})!'.format(msg, _t))
+    return buf
+def decode_binary(data, x=0):
+    # returns (value, offset of next value)
+    _t = data[x]
+    if 0x07 == _t:
+        _n = data[x + 1]
+        return data[x + 2:x + 2 + _n].decode('utf-8'), x + 2 + _n
+    if 0x03 == _t:
+        return data[x + 1], x + 2
+    if 0x0c == _t or 0x0d == _t:
+        _n, x = ((data[x + 1], x + 2) if 0x0c == _t else (_U32.unpack_from(data, x + 1)[0], x + 5))
+        _retval = {}
+        for _ in range(_n):
+            k, x = decode_binary(data, x)
+            _retval[k], x = decode_binary(data, x)
+        return _retval, x
+    if 0x09 == _t:
+        _n = data[x + 1]
+        return list(data[x + 2:x + 2 + _n]), x + 2 + _n
+    if 0x0a == _t or 0x0b == _t:
+        _n, x = ((data[x + 1], x + 2) if 0x0a == _t else (_U32.unpack_from(data, x + 1)[0], x + 5))
+        _retval = []
+        for _ in range(_n):
+            v, x = decode_binary(data, x)
+            _retval.append(v)
+        return _retval, x
+    if 0x04 == _t: return _I64.unpack_from(data, x + 1)[0], x + 9
+    if 0x00 == _t: return None, x + 1
+    if 0x01 == _t: return False, x + 1
+    if 0x02 == _t: return True, x + 1
+    if 0x06 == _t: return _F64.unpack_from(data, x + 1)[0], x + 9
+    _n = _U32.unpack_from(data, x + 1)[0]
+    if 0x08 == _t: return data[x + 5:x + 5 + _n].decode('utf-8'), x + 5 + _n
+    if 0x0e == _t: return list(data[x + 5:x + 5 + _n]), x + 5 + _n
+    if 0x05 == _t: return int.from_bytes(data[x + 5:x + 5 + _n], 'little', signed=True), x + 5 + _n
+    raise ValueError('Unknown tag: 0x{:02x}'.format(_t))
+
+# NOTE: every message carries its codec's 1-byte ID, so any message can be
+#       decoded no matter which codec the two ends of the connection chose;
+#       JSON (zlib-compressed) is kept as a human-readable debug fallback
+CODECS = {
+    'json': {
+        'id': 0,
+        'encode': lambda x: zlib.compress(json.dumps(x).encode('ascii'), level=zlib.Z_BEST_SPEED),
+        'decode': lambda x: json.loads(zlib.decompress(x)),
+    },
+    'binary': {
+        'id': 1,
+        'encode': lambda x: encode_binary(x, bytearray()),
+        'decode': lambda x: decode_binary(x)[0],
+    },
+}
+DECODERS = {v.get('id'): v.get('decode') for v in CODECS.values()}
+def envelope(msg):
+    return {
+        str: lambda : {'text': msg},
+        dict: lambda : msg,
+    }.get(type(msg), lambda : {'error': 'Undeliverable object'})()
+def normalize(msg):
+    # NOTE: copy msg as a trip through any codec would, i.e., with tuples
+    #       made lists and dict keys made strings, so that neither end of a
+    #       Channel shares (and can mutate) the other's objects
+    _t = type(msg)
+    if dict == _t: return {_key(k): (normalize(v) if type(v) in (dict, list, tuple) else v) for k, v in msg.items()}
+    if list == _t or tuple == _t: return [(normalize(v) if type(v) in (dict, list, tuple) else v) for v in msg]
+    return msg
+def format(msg, codec='json'):
+    _codec = CODECS.get(codec)
+    _message = bytes((_codec.get('id'),)) + _codec.get('encode')(envelope(msg))
+    return len(_message).to_bytes(Service.HEADER_SIZE, 'little') + _message
 def unformat(data):
-    return json.loads(zlib.decompress(data))
+    return DECODERS.get(data[0])(data[1:])
 def tx(s, msg, **kwargs):
-    s.send(msg if kwargs.get('already_formatted') else format(msg))
-def rx(s):
-    _msg = s.recv(Service.MESSAGE_SIZE, socket.MSG_WAITALL)
-    while not len(_msg.strip()):
-        time.sleep(0.001)
-        continue
+    s.sendall(msg if kwargs.get('already_formatted') else format(msg, kwargs.get('codec', 'json')))
+# NOTE: bytes received on a socket beyond the end of the message being
+#       rx'd are kept here until the next rx() on the same socket, so a burst
+#       of messages (e.g., a core's results for the current cycle) costs one
+#       recv() rather than two per message
+_PENDING = weakref.WeakKeyDictionary()
+RECV_SIZE = 2**16
+def unframe(buf):
+    # returns (and removes from buf) the first complete message in buf, or
+    # the number of bytes buf is known to be short of a complete message
+    if Service.HEADER_SIZE > len(buf): return Service.HEADER_SIZE - len(buf)
+    _size = Service.HEADER_SIZE + int.from_bytes(buf[:Service.HEADER_SIZE], 'little')
+    if _size > len(buf): return _size - len(buf)
+    _msg = bytes(buf[Service.HEADER_SIZE:_size])
+    del buf[:_size]
     return unformat(_msg)
+def rx(s):
+    _buf = _PENDING.setdefault(s, bytearray())
+    while True:
+        _msg = unframe(_buf)
+        if not isinstance(_msg, int): return _msg
+        _chunk = s.recv(max(RECV_SIZE, _msg)) # NOTE: blocks until the peer sends something
+        if not len(_chunk):
+            _PENDING.pop(s, None)
+            return {'text': 'bye'} # NOTE: a closed connection is treated the same as an explicit goodbye
+        _buf += _chunk
 
 if __name__ == '__main__':
-    pass
\ No newline at end of file
+    pass
@@ -0,0 +1,59 @@
+# Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
+
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'components', 'simplemainmem'))
+
+import mainmem
+
+CAPACITY = 2**32
+PAGESIZE = 2**12
+
+class Sink:
+    # NOTE: stands in for the launcher connection, e.g., for restore()'s
+    #       register messages to the cores
+    def __init__(self): self.msgs = []
+    def tx(self, msg): self.msgs.append(msg)
+
+def memory(filename):
+    _retval = mainmem.SimpleMainMemory('mainmem', {}, s=Sink(), filename=filename, capacity=CAPACITY, pagesize=PAGESIZE, backend='sparse')
+    _retval.boot()
+    return _retval
+def legacy_snapshot(mm, filename, instructions_committed):
+    # NOTE: the original format, i.e., a copy of the whole mainmem file
+    #       with the state appended at capacity
+    _state = bytes(json.dumps({
+        'instructions_committed': instructions_committed,
+        'registers': {'%pc': 0x1000},
+        'mmu': mm.mmu.translations,
+    }), encoding='ascii')
+    with open(filename, 'wb') as fp:
+        for f in mm.mmu.frames.keys():
+            fp.seek(f)
+            fp.write(mm.mm[f:f + PAGESIZE])
+        fp.seek(CAPACITY)
+        fp.write(len(_state).to_bytes(8, 'little'))
+        fp.write(_state)
+
+def test_restore_legacy_then_snapshot(tmp_path):
+    _pages = {0x1_0000: b'text', 0x7fff_0000: b'argv', 0x2_0000: b'data'}
+    _a = memory(str(tmp_path / 'a.raw'))
+    for addr, data in _pages.items(): _a.poke(addr, len(data), data, coreid=0)
+    legacy_snapshot(_a, str(tmp_path / 'legacy.snapshot'), 100)
+    _b = memory(str(tmp_path / 'b.raw'))
+    _b.restore(str(tmp_path / 'legacy.snapshot'))
+    _b.poke(0x2_0000, 4, b'DATA', coreid=0)
+    _pages.update({0x2_0000: b'DATA'})
+    _snapshot_filename = _b.snapshot({
+        'instructions_committed': 1500,
+        'cores': {0: {'instructions_committed': 1500, 'registers': {'%pc': 0x1004}}},
+        'cmdline': [],
+    })
+    _state, _ = _b.snapshot_state(_snapshot_filename)
+    assert None == _state.get('snapshot').get('base')
+    assert sorted(_a.mmu.frames.keys()) == _state.get('snapshot').get('frames')
+    _c = memory(str(tmp_path / 'c.raw'))
+    _c.restore(_snapshot_filename)
+    for addr, data in _pages.items(): assert list(data) == _c.peek(addr, len(data), coreid=0)
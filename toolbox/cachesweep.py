@@ -0,0 +1,129 @@
+# Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
+
+# Evaluate many SimpleCache geometries against one memory-access trace
+# (see: toolbox/memtrace.py) without re-running the simulator for each. For
+# LRU, every access's stack distance (i.e., the number of distinct blocks
+# in its set touched since the previous access to its block) is computed
+# once per (nbytesperblock, nsets), and an access hits in an nways cache
+# iff its stack distance is less than nways, so all the nways values come
+# from a single pass; other eviction policies are replayed through
+# SimpleCache, one geometry at a time. The results are a list of
+# {'config': ..., 'stats': ...} in the same form as executor.py's configs
+# and launcher.py's stats.json, e.g.,
+#
+#   python3 toolbox/cachesweep.py --cache l1dc --nsets 16 64 --nways 1 2 4 8 \
+#       --nbytesperblock 16 32 --evictionpolicy lru plru -- /tmp/sum.trace
+
+import sys
+import argparse
+import itertools
+import json
+
+import numpy as np
+
+import memtrace
+import simplecache
+
+CACHES = {
+    'l1ic': {'service': 'fetch', 'config': 'l1ic_', 'stats': 'l1ic_', 'kinds': [memtrace.FETCH]},
+    'l1dc': {'service': 'lsu', 'config': 'l1dc_', 'stats': 'l1dc_', 'kinds': [memtrace.LOAD, memtrace.STORE]},
+    'l2': {'service': 'l2', 'config': '', 'stats': 'l2_', 'kinds': [memtrace.FETCH, memtrace.LOAD, memtrace.STORE]},
+}
+
+def load(filename, kinds):
+    _records = np.fromfile(filename, dtype=np.dtype([('addr', '<u8'), ('size', 'u1'), ('kind', 'u1')]))
+    return _records[np.isin(_records['kind'], kinds)]
+def blocks(records, nbytesperblock):
+    # return : block number of each access, in order; an access that spans
+    #          two blocks (e.g., a misaligned load) is two accesses
+    _offsetbits = simplecache.log2(nbytesperblock)
+    _first = records['addr'] >> np.uint64(_offsetbits)
+    _last = (records['addr'] + np.maximum(records['size'], 1).astype(np.uint64) - np.uint64(1)) >> np.uint64(_offsetbits)
+    _nblocks = 1 + (_last - _first).astype(np.int64)
+    _starts = np.cumsum(_nblocks) - _nblocks
+    return np.repeat(_first, _nblocks) + (np.arange(_nblocks.sum()) - np.repeat(_starts, _nblocks)).astype(np.uint64)
+def dominance(values, X, Y):
+    # return : for each query j, #{k < X[j] : values[k] <= Y[j]}; [0, X[j])
+    #          is split into aligned power-of-2 runs of indices (one per
+    #          bit set in X[j]), and each run is searched in a copy of
+    #          values sorted within runs of that size
+    _n = len(values)
+    _M = 2 + int(values.max(initial=0))
+    _retval = np.zeros(len(X), dtype=np.int64)
+    for l in range(max(1, int(X.max(initial=0)).bit_length())):
+        _q = np.nonzero((X >> l) & 1)[0]
+        if not len(_q): continue
+        _keys = np.sort(((np.arange(_n, dtype=np.int64) >> l) * _M) + values)
+        _blk = (X[_q] >> l) - 1
+        _retval[_q] += np.searchsorted(_keys, (_blk * _M) + Y[_q], 'right') - (_blk << l)
+    return _retval
+def stack_distances(blks, nsets):
+    # return : LRU stack distance of each access, or -1 for the first access
+    #          to a block (i.e., a cold miss)
+    _order = np.argsort(blks & np.uint64(nsets - 1), kind='stable')
+    _b = blks[_order] # NOTE: each set's accesses are contiguous and in order
+    _n = len(_b)
+    _byblock = np.argsort(_b, kind='stable')
+    _same = np.zeros(_n, dtype=bool)
+    _same[1:] = _b[_byblock[1:]] == _b[_byblock[:-1]]
+    _prev = np.full(_n, -1, dtype=np.int64)
+    _prev[_byblock[1:][_same[1:]]] = _byblock[:-1][_same[1:]]
+    _next = np.full(_n, _n, dtype=np.int64)
+    _next[_byblock[:-1][_same[1:]]] = _byblock[1:][_same[1:]]
+    _r = np.nonzero(-1 != _prev)[0]
+    _p = _prev[_r]
+    # NOTE: the distinct blocks accessed strictly between p and r are those
+    #       accessed at k in (p, r) whose next access is after r, i.e.,
+    #       (r - p - 1) less #{p < k < r : next[k] < r}
+    _before = np.concatenate(([0], np.cumsum(np.bincount(_next[_next < _n], minlength=_n))))[_r]
+    _retval = np.full(_n, -1, dtype=np.int64)
+    _retval[_r] = (_r - _p - 1) - (_before - dominance(_next, _p + 1, _r - 1))
+    return _retval
+def lru(blks, nsets, nways):
+    # return : {nways: misses}
+    _d = stack_distances(blks, nsets)
+    _cold = int(np.count_nonzero(-1 == _d))
+    _tail = np.cumsum(np.bincount(_d[-1 != _d], minlength=1 + max(nways))[::-1])[::-1] # NOTE: _tail[w] = #{d >= w}
+    return {w: _cold + (int(_tail[w]) if w < len(_tail) else 0) for w in nways}
+def replay(blks, nsets, nways, nbytesperblock, evictionpolicy):
+    # return : misses
+    _cache = simplecache.SimpleCache(nsets, nways, nbytesperblock, evictionpolicy)
+    _retval = 0
+    for b in (blks << np.uint64(simplecache.log2(nbytesperblock))).tolist():
+        if None != _cache.peek(b, 1): continue
+        _retval += 1
+        _cache.poke(b, [0xff])
+    return _retval
+def sweep(records, cache, nsets, nways, nbytesperblock, evictionpolicy):
+    _retval = []
+    for b, s in itertools.product(nbytesperblock, nsets):
+        _blks = blocks(records, b)
+        for p in evictionpolicy:
+            _misses = (lru(_blks, s, nways) if 'lru' == p else {w: replay(_blks, s, w, b, p) for w in nways})
+            for w in nways:
+                _retval.append({
+                    'config': {
+                        '{}:{}{}'.format(CACHES.get(cache).get('service'), CACHES.get(cache).get('config'), k): v
+                        for k, v in [('nsets', s), ('nways', w), ('nbytesperblock', b), ('evictionpolicy', p)]
+                    },
+                    'stats': {'0': {CACHES.get(cache).get('service'): {
+                        '{}accesses'.format(CACHES.get(cache).get('stats')): len(_blks),
+                        '{}misses'.format(CACHES.get(cache).get('stats')): _misses.get(w),
+                    }}},
+                })
+    return _retval
+
+if '__main__' == __name__:
+    parser = argparse.ArgumentParser(description='Nebula: Trace-Driven Cache Sweep')
+    parser.add_argument('--cache', type=str, dest='cache', default='l1dc', choices=list(CACHES.keys()), help='cache to model; l2 sees every access, i.e., as if there were no L1s')
+    parser.add_argument('--nsets', type=int, dest='nsets', nargs='+', default=[2**4], help='numbers of sets')
+    parser.add_argument('--nways', type=int, dest='nways', nargs='+', default=[2**1], help='numbers of ways')
+    parser.add_argument('--nbytesperblock', type=int, dest='nbytesperblock', nargs='+', default=[2**4], help='numbers of bytes per block')
+    parser.add_argument('--evictionpolicy', type=str, dest='evictionpolicy', nargs='+', default=['lru'], choices=list(simplecache.replacement.POLICIES.keys()), help='eviction policies')
+    parser.add_argument('--output_filename', type=str, dest='output_filename', default=None, help='file to output JSON results to')
+    parser.add_argument('trace', help='trace file, e.g., from fastcore:trace_filename or basicblockcore:trace_filename')
+    args = parser.parse_args()
+    _records = load(args.trace, CACHES.get(args.cache).get('kinds'))
+    _results = sweep(_records, args.cache, args.nsets, args.nways, args.nbytesperblock, args.evictionpolicy)
+    fp = (sys.stdout if not args.output_filename else open(args.output_filename, 'w'))
+    json.dump(_results, fp, indent=4)
@@ -0,0 +1,89 @@
+# Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
+
+# What the simulator needs from a binary's ELF file (the sections to be
+# loaded, the symbol table, and the address of each function) is parsed
+# once, then kept in memory, keyed by the binary's path and modification
+# time, and saved next to the binary, so that neither later programs in
+# the same process, nor later processes, parse it again.
+
+import os
+import json
+import bisect
+
+import elftools.elf.elffile
+import elftools.elf.sections
+import elftools.elf.constants
+
+CACHE = {}
+VERSION = 2 # NOTE: bump whenever parse() changes, so stale cache files are reparsed
+
+def cachefile(binary): return os.path.join(os.path.dirname(binary), '.{}.elf.json'.format(os.path.basename(binary)))
+def parse(binary):
+    with open(binary, 'rb') as fp:
+        elffile = elftools.elf.elffile.ELFFile(fp)
+        _sections = [{
+            'name': s.name,
+            'addr': s.header.sh_addr,
+            'size': s.data_size,
+            'data': s.data(),
+        } for s in filter(lambda x: x.header.sh_addr, elffile.iter_sections())]
+        _symbols = {}
+        _functions = set()
+        _text = set(map(lambda x: x[0], filter(lambda x: x[-1].header.sh_flags & elftools.elf.constants.SH_FLAGS.SHF_EXECINSTR, enumerate(elffile.iter_sections()))))
+        for tab in filter(lambda x: isinstance(x, elftools.elf.sections.SymbolTableSection), elffile.iter_sections()):
+            for s in tab.iter_symbols():
+                _symbols.setdefault(s.name, []).append(s.entry.st_value)
+                # NOTE: besides functions, untyped symbols in executable
+                #       sections, e.g., _start and assembly labels, since
+                #       PCs can be in those, too; but not mapping symbols
+                #       (e.g., $xrv64i2p0...), which mark ISA extensions
+                if not s.name or s.name.startswith('$') or not s.entry.st_shndx in _text: continue
+                if s.entry.st_info.type in ['STT_FUNC', 'STT_NOTYPE']: _functions.add((s.entry.st_value, s.name))
+    return {
+        'sections': _sections,
+        'symbols': _symbols,
+        'functions': sorted(_functions),
+    }
+def image(binary):
+    # return : {'sections': [{'name', 'addr', 'size', 'data'}, ...],
+    #           'symbols': {name: [value, ...]},
+    #           'functions': [(addr, name), ...] (sorted)}
+    _binary = os.path.abspath(binary)
+    _stat = os.stat(_binary)
+    _key = (_binary, _stat.st_mtime_ns, _stat.st_size, VERSION)
+    if _key in CACHE.keys(): return CACHE.get(_key)
+    _retval = None
+    try:
+        with open(cachefile(_binary)) as fp: _cached = json.load(fp)
+        if list(_key) == _cached.get('key'): _retval = {
+            'sections': list(map(lambda x: {**x, **{'data': bytes.fromhex(x.get('data'))}}, _cached.get('sections'))),
+            'symbols': _cached.get('symbols'),
+            'functions': list(map(tuple, _cached.get('functions'))),
+        }
+    except (OSError, ValueError, AttributeError, TypeError):
+        pass
+    if None == _retval:
+        _retval = parse(_binary)
+        try:
+            _tmp = '{}.{}'.format(cachefile(_binary), os.getpid()) # NOTE: many processes may parse the same binary at once
+            with open(_tmp, 'w') as fp: json.dump({
+                'key': list(_key),
+                'sections': list(map(lambda x: {**x, **{'data': x.get('data').hex()}}, _retval.get('sections'))),
+                'symbols': _retval.get('symbols'),
+                'functions': _retval.get('functions'),
+            }, fp)
+            os.replace(_tmp, cachefile(_binary))
+        except OSError:
+            pass # NOTE: e.g., the binary's directory is read-only; the cache in memory still works
+    CACHE.update({_key: _retval})
+    return _retval
+def symbol(binary, name):
+    _values = image(binary).get('symbols').get(name, [])
+    assert 0 < len(_values), 'No {} symbol!'.format(name)
+    assert 2 > len(_values), 'More than one {} symbol?!?!?!?'.format(name)
+    return next(iter(_values))
+def function(image, addr):
+    # return : name of the function addr is in, i.e., of the function at
+    #          the highest address not above addr
+    _x = bisect.bisect_right(image.get('functions'), (addr, chr(0x10ffff)))
+    return (image.get('functions')[_x - 1][-1] if _x else '')
@@ -0,0 +1,31 @@
+# Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
+
+# Memory-access traces, i.e., every instruction fetch, load, and store a
+# core performs, in order, e.g., as recorded by Amanatsu and Jabara (see:
+# fastcore:trace_filename and basicblockcore:trace_filename), for
+# toolbox/cachesweep.py. A trace is a flat file of fixed-size records,
+# one per access, each the access's (virtual) address, size in bytes, and
+# kind (FETCH, LOAD, or STORE), little-endian.
+
+import struct
+
+RECORD = struct.Struct('<QBB')
+FETCH = 0
+LOAD = 1
+STORE = 2
+KINDS = {
+    'fetch': FETCH,
+    'load': LOAD,
+    'store': STORE,
+}
+
+class Trace:
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = bytearray() # NOTE: written to filename by flush()
+        open(self.filename, 'wb').close()
+    def append(self, addr, size, kind):
+        self.records += RECORD.pack(addr & 0xffff_ffff_ffff_ffff, size, kind)
+    def flush(self):
+        with open(self.filename, 'ab') as fp: fp.write(self.records)
+        self.records.clear()
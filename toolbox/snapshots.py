@@ -0,0 +1,201 @@
+# Copyright (C) 2021, 2022, 2023, 2024 John Haskins Jr.
+
+# A content-addressed store of main memory snapshots: each page is kept
+# once, compressed, under its SHA-256 no matter how many snapshots (of
+# however many binaries) contain it, and each snapshot is a small manifest
+# of its state and the hashes of its pages. Any snapshot in the store can
+# be materialized into a file for launcher.py --restore.
+#
+#   <store>/pages/<first 2 hex digits>/<hash>.<compression>
+#   <store>/snapshots/<name>.json
+
+import os
+import argparse
+import hashlib
+import zlib
+import lzma
+import json
+
+MAGIC = b'nebula.snapshot\n' # NOTE: must match SimpleMainMemory.SNAPSHOT_MAGIC
+BASE = 0x1000_0000 # NOTE: must match SimpleMMU.BASE
+COMPRESSION = {
+    'zlib': {
+        'compress': lambda x: zlib.compress(x, level=9),
+        'decompress': zlib.decompress,
+    },
+    'lzma': {
+        'compress': lzma.compress,
+        'decompress': lzma.decompress,
+    },
+}
+
+def snapshot_state(filename, capacity):
+    # return : (state, offset of the first page), or (state, None) for a
+    # snapshot in the original format, i.e., a whole mainmem image with the
+    # state appended at capacity
+    with open(filename, 'rb') as fp:
+        _original = MAGIC != fp.read(len(MAGIC))
+        if _original: fp.seek(capacity)
+        _state_length = int.from_bytes(fp.read(8), 'little')
+        _retval = json.loads(str(fp.read(_state_length), encoding='ascii'))
+        return _retval, (None if _original else fp.tell())
+def snapshot_pages(filename, capacity, pagesize):
+    # return : (state, pagesize, {frame: page}) for every frame mapped by
+    # the snapshot's MMU, following a delta snapshot's chain of bases
+    _state, _offset = snapshot_state(filename, capacity)
+    _frames = set(map(lambda x: x.get('frame'), _state.get('mmu').values()))
+    _retval = {}
+    if None == _offset:
+        with open(filename, 'rb') as fp:
+            for f in _frames:
+                fp.seek(f)
+                _retval.update({f: fp.read(pagesize)})
+        return _state, pagesize, _retval
+    _pagesize = _state.get('snapshot').get('pagesize')
+    _filename, _s = filename, _state
+    while len(_frames) and _filename:
+        with open(_filename, 'rb') as fp:
+            for x, f in enumerate(_s.get('snapshot').get('frames')):
+                if f not in _frames: continue
+                fp.seek(_offset + (x * _pagesize))
+                _retval.update({f: fp.read(_pagesize)})
+                _frames.remove(f)
+        _base = _s.get('snapshot').get('base')
+        _filename = (os.path.join(os.path.dirname(os.path.abspath(_filename)), _base) if _base else None)
+        if _filename: _s, _offset = snapshot_state(_filename, capacity)
+    return _state, _pagesize, _retval
+
+class SnapshotStore:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(self.path, 'pages'), exist_ok=True)
+        os.makedirs(os.path.join(self.path, 'snapshots'), exist_ok=True)
+    def manifest(self, name): return os.path.join(self.path, 'snapshots', '{}.json'.format(name))
+    def page(self, digest):
+        # return : filename of the page with the given hash, if stored
+        _dir = os.path.join(self.path, 'pages', digest[:2])
+        return next(filter(lambda x: os.path.exists(x), map(lambda c: os.path.join(_dir, '{}.{}'.format(digest, c)), COMPRESSION.keys())), None)
+    def put(self, data, compression):
+        _digest = hashlib.sha256(data).hexdigest()
+        if self.page(_digest): return _digest, 0
+        _filename = os.path.join(self.path, 'pages', _digest[:2], '{}.{}'.format(_digest, compression))
+        os.makedirs(os.path.dirname(_filename), exist_ok=True)
+        with open('{}.tmp'.format(_filename), 'wb') as fp: fp.write(COMPRESSION.get(compression).get('compress')(data))
+        os.replace('{}.tmp'.format(_filename), _filename) # NOTE: so a page is never seen half-written
+        return _digest, os.path.getsize(_filename)
+    def get(self, digest):
+        _filename = self.page(digest)
+        assert _filename, 'Page {} missing from store!'.format(digest)
+        with open(_filename, 'rb') as fp: return COMPRESSION.get(_filename.split('.')[-1]).get('decompress')(fp.read())
+    def names(self): return sorted(map(lambda x: x[:-len('.json')], filter(lambda x: x.endswith('.json'), os.listdir(os.path.join(self.path, 'snapshots')))))
+    def load(self, name):
+        with open(self.manifest(name)) as fp: return json.load(fp)
+    def add(self, name, filename, capacity, pagesize, compression):
+        _state, _pagesize, _pages = snapshot_pages(filename, capacity, pagesize)
+        _state.pop('snapshot', None)
+        _frames = {}
+        _new = 0
+        for f, d in sorted(_pages.items()):
+            if not any(d): continue # NOTE: all-zero pages are implied
+            _digest, _n = self.put(d, compression)
+            _frames.update({f: _digest})
+            _new += (1 if _n else 0)
+        with open('{}.tmp'.format(self.manifest(name)), 'w') as fp: json.dump({
+            'state': _state,
+            'pagesize': _pagesize,
+            'frames': _frames,
+        }, fp)
+        os.replace('{}.tmp'.format(self.manifest(name)), self.manifest(name))
+        return len(_frames), _new
+    def materialize(self, name, filename):
+        # NOTE: writes a self-contained snapshot, i.e., one with no base,
+        #       in the format SimpleMainMemory.restore() reads
+        _manifest = self.load(name)
+        _frames = sorted(map(lambda x: (int(x[0]), x[1]), _manifest.get('frames').items()))
+        _state = json.dumps({
+            **_manifest.get('state'),
+            **{
+                'snapshot': {
+                    'pagesize': _manifest.get('pagesize'),
+                    'base': None,
+                    'frames': list(map(lambda x: x[0], _frames)),
+                },
+            },
+        })
+        with open(filename, 'wb') as fp:
+            fp.write(MAGIC)
+            fp.write(len(_state).to_bytes(8, 'little'))
+            fp.write(bytes(_state, encoding='ascii'))
+            for _, d in _frames: fp.write(self.get(d))
+        return len(_frames)
+    def merge(self, name, names):
+        # NOTE: makes one multi-core snapshot of single-core snapshots, the
+        #       first on core 0, the second on core 1, etc., each with its
+        #       own frames; the command lines that remained are run, in
+        #       order, on whichever cores are idle
+        _pagesize = self.load(names[0]).get('pagesize')
+        _state = {'cycle': 0, 'instructions_committed': 0, 'cmdline': [], 'cores': {}, 'mmu': {}}
+        _frames = {}
+        for c, n in enumerate(names):
+            _manifest = self.load(n)
+            _s = _manifest.get('state')
+            assert _pagesize == _manifest.get('pagesize'), 'Snapshot {} pagesize ({}) does not match {} ({})!'.format(n, _manifest.get('pagesize'), names[0], _pagesize)
+            _cores = _s.get('cores', {0: {'instructions_committed': _s.get('instructions_committed'), 'registers': _s.get('registers')}})
+            assert 1 == len(_cores), 'Snapshot {} is not single-core!'.format(n)
+            _state.update({
+                'cycle': max(_state.get('cycle'), _s.get('cycle')),
+                'instructions_committed': _state.get('instructions_committed') + _s.get('instructions_committed'),
+                'cmdline': _state.get('cmdline') + (_s.get('cmdline') if 'cores' in _s.keys() else []),
+            })
+            _state.get('cores').update({c: next(iter(_cores.values()))})
+            for k, v in sorted(_s.get('mmu').items(), key=lambda x: x[1].get('frame')):
+                _frame = BASE + (len(_state.get('mmu')) * _pagesize)
+                _state.get('mmu').update({(int(k) & ~(_pagesize - 1)) | c: {'frame': _frame, 'coreid': c}})
+                _digest = _manifest.get('frames').get(str(v.get('frame')))
+                if _digest: _frames.update({_frame: _digest})
+        with open('{}.tmp'.format(self.manifest(name)), 'w') as fp: json.dump({
+            'state': _state,
+            'pagesize': _pagesize,
+            'frames': _frames,
+        }, fp)
+        os.replace('{}.tmp'.format(self.manifest(name)), self.manifest(name))
+        return len(names), len(_frames)
+    def remove(self, name):
+        # NOTE: also deletes pages no remaining snapshot refers to
+        os.unlink(self.manifest(name))
+        _live = set(sum(map(lambda x: list(self.load(x).get('frames').values()), self.names()), []))
+        _retval = 0
+        for _dir, _, _files in os.walk(os.path.join(self.path, 'pages')):
+            for f in filter(lambda x: x.split('.')[0] not in _live, _files):
+                os.unlink(os.path.join(_dir, f))
+                _retval += 1
+        return _retval
+
+if '__main__' == __name__:
+    parser = argparse.ArgumentParser(description='Nebula: Snapshot Store')
+    parser.add_argument('--store', type=str, dest='store', required=True, help='directory holding the snapshot store')
+    parser.add_argument('--capacity', type=int, dest='capacity', default=2**32, help='mainmem:capacity of snapshots in the original format')
+    parser.add_argument('--pagesize', type=int, dest='pagesize', default=2**16, help='mainmem:pagesize of snapshots in the original format')
+    parser.add_argument('--compression', type=str, dest='compression', default='zlib', choices=list(COMPRESSION.keys()), help='compression for newly stored pages')
+    parser.add_argument('--prefix', type=str, dest='prefix', default='', help='prefix for names of added snapshots')
+    parser.add_argument('cmd', choices=['add', 'list', 'materialize', 'merge', 'remove'], help='add snapshot files; list snapshots; materialize snapshot NAME into FILE; merge single-core snapshots into multi-core snapshot NAME; remove snapshots')
+    parser.add_argument('args', nargs='*', help='snapshot files (add), NAME FILE (materialize), NAME names (merge), or names (remove)')
+    args = parser.parse_args()
+    _store = SnapshotStore(args.store)
+    if 'add' == args.cmd:
+        for s in args.args:
+            _name = '{}{}'.format(args.prefix, os.path.basename(s))
+            _n, _new = _store.add(_name, s, args.capacity, args.pagesize, args.compression)
+            print('{} : {} pages ({} new)'.format(_name, _n, _new))
+    elif 'list' == args.cmd:
+        for n in _store.names():
+            _manifest = _store.load(n)
+            print('{} : {} pages, {} instructions'.format(n, len(_manifest.get('frames')), _manifest.get('state').get('instructions_committed')))
+    elif 'materialize' == args.cmd:
+        assert 2 == len(args.args), 'materialize requires NAME and FILE!'
+        print('{} : {} pages'.format(args.args[1], _store.materialize(*args.args)))
+    elif 'merge' == args.cmd:
+        assert 3 <= len(args.args), 'merge requires NAME and at least two snapshots!'
+        print('{} : {} cores, {} pages'.format(args.args[0], *_store.merge(args.args[0], args.args[1:])))
+    elif 'remove' == args.cmd:
+        for n in args.args: print('{} : {} pages deleted'.format(n, _store.remove(n)))